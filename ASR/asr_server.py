@@ -1,20 +1,191 @@
 from fastapi import FastAPI, Request, HTTPException
-from pathlib import Path
-from datetime import datetime
+import asyncio
+import bisect
 import logging
+import os
+import struct
+from contextlib import asynccontextmanager, suppress
 import uvicorn
-import wave
-import whisper
 import numpy as np  # make sure: pip install numpy
-
-app = FastAPI()
-
-SAVE_DIR = Path("received_audio")
-SAVE_DIR.mkdir(exist_ok=True)
+import ctranslate2
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 
 logging.basicConfig(level=logging.INFO)
 
-MODEL = whisper.load_model("base")  # or "tiny", "small", etc.
+# Model size ("tiny", "base", "small", ...) or a path to a pre-converted
+# CTranslate2 model directory (the Docker image bakes one in at build time).
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "base")
+
+# "auto" picks CUDA when a GPU is visible. On GPU, CTranslate2 keeps the mel
+# features and decoder KV cache resident on device for the whole decode.
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "auto")
+if WHISPER_DEVICE == "auto":
+    WHISPER_DEVICE = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+
+# CTranslate2 int8 kernels: ~4x faster and ~2x lighter than openai-whisper on
+# CPU. On CPUs with AVX512-BF16/AMX (Sapphire Rapids, Zen 4) set
+# WHISPER_COMPUTE_TYPE=int8_bfloat16 to keep int8 weights with bf16 activations.
+WHISPER_COMPUTE_TYPE = os.environ.get(
+    "WHISPER_COMPUTE_TYPE", "float16" if WHISPER_DEVICE == "cuda" else "int8"
+)
+
+# Inferences that can run at once; the cores are split between them so the
+# workers don't oversubscribe the CPU
+NUM_WORKERS = 2
+
+MODEL = WhisperModel(
+    WHISPER_MODEL,
+    device=WHISPER_DEVICE,
+    compute_type=WHISPER_COMPUTE_TYPE,
+    cpu_threads=max(1, (os.cpu_count() or 4) // NUM_WORKERS),
+    num_workers=NUM_WORKERS,
+)
+
+SAMPLE_RATE = 16000
+# Utterances up to one Whisper window from concurrent requests are decoded
+# together: the batcher collects up to ASR_BATCH_SIZE of them within
+# ASR_BATCH_WINDOW seconds and runs them as one padded batch. Longer clips
+# span several windows and go through the sequential path
+BATCHED_MODEL = BatchedInferencePipeline(model=MODEL)
+BATCH_SIZE = int(os.environ.get("ASR_BATCH_SIZE", "8"))
+BATCH_WINDOW = float(os.environ.get("ASR_BATCH_WINDOW", "0.02"))
+MAX_BATCHED_SAMPLES = 30 * SAMPLE_RATE
+
+# Bounds concurrent inferences (match num_workers) while the event loop keeps
+# accepting and parsing uploads
+SEM = asyncio.Semaphore(int(os.environ.get("ASR_CONCURRENCY", str(NUM_WORKERS))))
+
+# (audio, future) pairs waiting for the batcher
+_pending: asyncio.Queue = asyncio.Queue()
+_batcher_task = None
+# In-flight _run_batch tasks; the loop only holds weak references to tasks
+_batch_tasks: set = set()
+
+
+def run_whisper(audio_np: np.ndarray) -> str:
+    segments, _ = MODEL.transcribe(
+        audio_np, language="en", beam_size=1
+    )  # or omit language to auto-detect
+    return "".join(seg.text for seg in segments).strip()
+
+
+def run_whisper_batch(clips: list) -> list:
+    """Transcribe several utterances of at most 30 s each in one batched decode.
+
+    The clips are laid end to end and each is passed as its own clip
+    timestamp, so every utterance is one row of the batch (no VAD split) and
+    each segment is mapped back to its clip by time.
+    """
+    starts = np.cumsum([0] + [len(clip) for clip in clips[:-1]]) / SAMPLE_RATE
+    clip_timestamps = [
+        {"start": start, "end": start + len(clip) / SAMPLE_RATE}
+        for start, clip in zip(starts.tolist(), clips)
+    ]
+    segments, _ = BATCHED_MODEL.transcribe(
+        np.concatenate(clips),
+        language="en",
+        beam_size=1,
+        batch_size=len(clips),
+        clip_timestamps=clip_timestamps,
+    )
+
+    texts = [[] for _ in clips]
+    start_times = [ts["start"] for ts in clip_timestamps]
+    for seg in segments:
+        clip = bisect.bisect_right(start_times, (seg.start + seg.end) / 2) - 1
+        texts[max(clip, 0)].append(seg.text)
+    return ["".join(parts).strip() for parts in texts]
+
+
+async def _run_batch(batch: list) -> None:
+    """Decode one batch and resolve each request's future; releases SEM."""
+    try:
+        texts = await asyncio.to_thread(run_whisper_batch, [audio for audio, _ in batch])
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+    except asyncio.CancelledError:
+        for _, future in batch:
+            future.cancel()
+        raise
+    else:
+        for (_, future), text in zip(batch, texts):
+            if not future.done():
+                future.set_result(text)
+    finally:
+        SEM.release()
+
+
+async def _batcher() -> None:
+    """Group queued utterances into batches; up to NUM_WORKERS batches run at once."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _pending.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_pending.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        await SEM.acquire()
+        task = asyncio.create_task(_run_batch(batch))
+        _batch_tasks.add(task)
+        task.add_done_callback(_batch_tasks.discard)
+
+
+def parse_wav(data: bytes):
+    """Walk the RIFF chunks of an in-memory WAV.
+
+    Returns (channels, sample_width, sample_rate, pcm) where pcm is a
+    zero-copy memoryview over the data chunk.
+    """
+    if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("Not a RIFF/WAVE file")
+
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, pos)
+        body = pos + 8
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack_from("<HHIIHH", data, body)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("data chunk precedes fmt chunk")
+            _, nchannels, framerate, _, _, bits = fmt
+            # Streaming writers may leave the size as a placeholder; clamp to the body
+            return nchannels, bits // 8, framerate, memoryview(data)[body:body + size]
+        pos = body + size + (size & 1)  # chunks are word aligned
+
+    raise ValueError("No data chunk found")
+
+
+def warmup_model():
+    # One throwaway pass per path so the first real request doesn't pay for
+    # lazy allocations (mel filters, decoder buffers, thread pools). Neither
+    # path applies VAD, so the silent clip still reaches the decoder
+    silence = np.zeros(SAMPLE_RATE, dtype=np.float32)
+    run_whisper(silence)
+    run_whisper_batch([silence])
+    logging.info(f"Whisper model warmed up ({WHISPER_DEVICE}, {WHISPER_COMPUTE_TYPE})")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _batcher_task
+    await asyncio.to_thread(warmup_model)
+    _batcher_task = asyncio.create_task(_batcher())
+    yield
+    _batcher_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await _batcher_task
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/transcribe")
@@ -23,30 +194,23 @@ async def transcribe(request: Request):
     if not data:
         raise HTTPException(status_code=400, detail="No audio data received")
 
-    filepath = SAVE_DIR / (datetime.now().strftime("%Y%m%d-%H%M%S") + ".wav")
-    with open(filepath, "wb") as f:
-        f.write(data)
-
     try:
-        with wave.open(str(filepath), "rb") as wf:
-            nchannels = wf.getnchannels()
-            sampwidth = wf.getsampwidth()
-            framerate = wf.getframerate()
-            nframes = wf.getnframes()
-
-            logging.info(
-                f"Received WAV: ch={nchannels}, width={sampwidth}, "
-                f"sr={framerate}, frames={nframes}"
-            )
-
-            if nchannels != 1:
-                raise ValueError(f"Expected mono audio, got {nchannels} channels")
-            if sampwidth != 2:
-                raise ValueError(f"Expected 16-bit PCM (2 bytes), got {sampwidth}")
-            if framerate != 16000:
-                raise ValueError(f"Expected 16 kHz sample rate, got {framerate}")
-
-            pcm_bytes = wf.readframes(nframes)
+        nchannels, sampwidth, framerate, pcm_bytes = parse_wav(data)
+        nframes = len(pcm_bytes) // (nchannels * sampwidth)
+
+        logging.info(
+            f"Received WAV: ch={nchannels}, width={sampwidth}, "
+            f"sr={framerate}, frames={nframes}"
+        )
+
+        if nchannels != 1:
+            raise ValueError(f"Expected mono audio, got {nchannels} channels")
+        if sampwidth != 2:
+            raise ValueError(f"Expected 16-bit PCM (2 bytes), got {sampwidth}")
+        if framerate != 16000:
+            raise ValueError(f"Expected 16 kHz sample rate, got {framerate}")
+
+        pcm_bytes = pcm_bytes[: nframes * nchannels * sampwidth]
 
     except Exception as e:
         logging.error(f"WAV parse error: {e}", exc_info=True)
@@ -56,9 +220,19 @@ async def transcribe(request: Request):
         )
 
     try:
-        audio_np = np.frombuffer(pcm_bytes, dtype=np.int16).astype(np.float32) / 32768.0
-        result = MODEL.transcribe(audio_np, language="en")  # or omit language to auto-detect
-        text = result.get("text", "").strip()
+        pcm = np.frombuffer(pcm_bytes, dtype=np.int16)
+        # Scale straight into the float32 buffer: one pass instead of a cast
+        # copy plus a divided copy. Allocated per request because queued and
+        # running transcriptions each hold their input until decoded.
+        audio_np = np.empty(len(pcm), dtype=np.float32)
+        np.multiply(pcm, np.float32(1.0 / 32768.0), out=audio_np)
+        if len(audio_np) <= MAX_BATCHED_SAMPLES:
+            future = asyncio.get_running_loop().create_future()
+            _pending.put_nowait((audio_np, future))
+            text = await future
+        else:
+            async with SEM:
+                text = await asyncio.to_thread(run_whisper, audio_np)
     except Exception as e:
         logging.error(f"Transcription error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Whisper transcription failed: {e}")
@@ -7,6 +7,7 @@ import sounddevice as sd
 import numpy as np
 import wave
 import time
+import threading
 from openwakeword import Model
 import openwakeword
 
@@ -18,15 +19,85 @@ OWW_FRAME_LENGTH = 1280
 VAD_FRAME_DURATION_MS = 30
 VAD_FRAME_SIZE = int(SAMPLE_RATE * VAD_FRAME_DURATION_MS / 1000)
 SILENCE_FRAMES = int(800 / VAD_FRAME_DURATION_MS)
+# RMS (int16 units, ~-50 dBFS) below which a VAD window is silence without
+# consulting WebRTC VAD
+VAD_ENERGY_FLOOR = 100.0
+# Audio kept from before the wake-word hit and prepended to the recording
+PREROLL_SECONDS = 1.0
+PREROLL_FRAMES = int(PREROLL_SECONDS * SAMPLE_RATE / OWW_FRAME_LENGTH)
+# Capture ring capacity; audio older than this is dropped if processing stalls
+RING_SECONDS = 4
+# Upper bound on a single utterance (sizes the preallocated recording buffer)
+MAX_RECORD_SECONDS = 30
+MAX_RECORD_SAMPLES = SAMPLE_RATE * MAX_RECORD_SECONDS
 OUTPUT_WAV = "utterance.wav"
 # Detection threshold for wake word (adjust between 0.0 and 1.0)
 WAKE_WORD_THRESHOLD = 0.5
+# Frames quieter than this (dBFS) are not scored by the wake-word model; they
+# are replayed from the pre-roll once the gate reopens
+WAKE_GATE_DB = -45.0
 # Cooldown period after detection (seconds) - prevents immediate re-detection
 COOLDOWN_SECONDS = 2.0
 
+class AudioRing:
+    """Preallocated int16 ring filled by the PortAudio callback thread.
+
+    The consumer copies straight into caller-owned arrays, so steady-state
+    capture allocates nothing per frame. If the consumer falls more than
+    `capacity` samples behind, the oldest audio is dropped.
+    """
+
+    def __init__(self, capacity):
+        self._buf = np.zeros(capacity, dtype=np.int16)
+        self._capacity = capacity
+        self._read = 0  # absolute sample counters; positions are taken modulo capacity
+        self._write = 0
+        self._cond = threading.Condition()
+
+    def write(self, samples):
+        n = len(samples)
+        with self._cond:
+            start = self._write % self._capacity
+            first = min(n, self._capacity - start)
+            self._buf[start:start + first] = samples[:first]
+            self._buf[:n - first] = samples[first:]
+            self._write += n
+            if self._write - self._read > self._capacity:
+                self._read = self._write - self._capacity
+            self._cond.notify()
+
+    def read_into(self, out):
+        n = len(out)
+        with self._cond:
+            while self._write - self._read < n:
+                self._cond.wait()
+            start = self._read % self._capacity
+            first = min(n, self._capacity - start)
+            out[:first] = self._buf[start:start + first]
+            out[first:] = self._buf[:n - first]
+            self._read += n
+        return out
+
 def is_speech(frame, vad):
     return vad.is_speech(frame.tobytes(), SAMPLE_RATE)
 
+def frame_energy_db(frame):
+    """Mean-square level of an int16 frame in dBFS."""
+    mean_square = np.mean(np.square(frame, dtype=np.float32)) / (32768.0 * 32768.0)
+    return 10.0 * np.log10(mean_square + 1e-12)
+
+def speech_flags(windows, vad):
+    """Classify a (n, VAD_FRAME_SIZE) block of windows in one pass.
+
+    RMS energy for every window is computed vectorized; only windows above
+    VAD_ENERGY_FLOOR are handed to WebRTC VAD, the rest are silence outright.
+    """
+    energy = np.sqrt(np.mean(np.square(windows, dtype=np.float32), axis=1))
+    flags = energy >= VAD_ENERGY_FLOOR
+    for i in np.flatnonzero(flags):
+        flags[i] = is_speech(windows[i], vad)
+    return flags
+
 def record_after_wake():
     oww_model = None
     stream = None
@@ -43,8 +114,28 @@ def record_after_wake():
         raise RuntimeError(f"OpenWakeWord initialization error: {e}")
     
     vad = webrtcvad.Vad(2)
+    ring = AudioRing(RING_SECONDS * SAMPLE_RATE)
+
+    def on_audio(indata, frames, time_info, status):
+        ring.write(indata[:, 0])
+
     # Use OpenWakeWord's recommended frame length for the stream
-    stream = sd.InputStream(samplerate=SAMPLE_RATE, channels=1, dtype='int16', blocksize=OWW_FRAME_LENGTH)
+    stream = sd.InputStream(
+        samplerate=SAMPLE_RATE,
+        channels=1,
+        dtype='int16',
+        blocksize=OWW_FRAME_LENGTH,
+        callback=on_audio,
+    )
+    # The most recent PREROLL_FRAMES listening frames, written in place by the
+    # ring so a detection can splice the speech onset into the recording
+    preroll = np.zeros((PREROLL_FRAMES, OWW_FRAME_LENGTH), dtype=np.int16)
+    frames_seen = 0
+    # Value of frames_seen when the model last received a frame
+    frames_fed = 0
+    # One allocation reused by every recording session: frames are copied in at
+    # a write cursor and VAD consumes 30ms views behind a read cursor
+    audio_buffer = np.empty(MAX_RECORD_SAMPLES, dtype=np.int16)
     
     try:
         stream.start()
@@ -54,8 +145,25 @@ def record_after_wake():
         cooldown_frames_to_flush = int(COOLDOWN_SECONDS * SAMPLE_RATE / OWW_FRAME_LENGTH)  # Frames to flush during cooldown
 
         while True:
-            pcm = stream.read(OWW_FRAME_LENGTH)[0].flatten()
-            
+            pcm = ring.read_into(preroll[frames_seen % PREROLL_FRAMES])
+            frames_seen += 1
+
+            # Idle room noise can't contain the wake word; skip the neural model
+            if frame_energy_db(pcm) < WAKE_GATE_DB:
+                continue
+
+            # openWakeWord scores against a rolling window of past features, so
+            # bring it up to date with the frames the gate skipped. Anything
+            # older than the pre-roll is gone; drop the stale context instead
+            skipped = frames_seen - 1 - frames_fed
+            if skipped:
+                if skipped >= PREROLL_FRAMES:
+                    oww_model.reset()
+                n_replay = min(skipped, PREROLL_FRAMES - 1)
+                for i in range(frames_seen - 1 - n_replay, frames_seen - 1):
+                    oww_model.predict(preroll[i % PREROLL_FRAMES])
+            frames_fed = frames_seen
+
             # Process audio through OpenWakeWord
             prediction = oww_model.predict(pcm)
             
@@ -70,39 +178,48 @@ def record_after_wake():
                 
                 last_detection_time = current_time
                 print("[Wake word detected!] Recording...")
-                frames = []
                 silence_counter = 0
-                # Buffer for VAD processing (need 30ms frames for VAD)
-                vad_buffer = np.array([], dtype=np.int16)
 
-                while True:
-                    frame = stream.read(OWW_FRAME_LENGTH)[0].flatten()
-                    frames.append(frame)
-                    vad_buffer = np.concatenate([vad_buffer, frame])
+                # Seed with the pre-roll (oldest first) so the utterance starts at
+                # the actual onset; VAD only judges audio after the detection
+                n_preroll = min(frames_seen, PREROLL_FRAMES)
+                order = np.arange(frames_seen - n_preroll, frames_seen) % PREROLL_FRAMES
+                write_pos = n_preroll * OWW_FRAME_LENGTH
+                audio_buffer[:write_pos] = preroll[order].ravel()
+                vad_pos = write_pos
+
+                while write_pos + OWW_FRAME_LENGTH <= MAX_RECORD_SAMPLES:
+                    ring.read_into(audio_buffer[write_pos:write_pos + OWW_FRAME_LENGTH])
+                    write_pos += OWW_FRAME_LENGTH
                     
-                    # Process VAD when we have enough samples (30ms = 480 samples)
-                    while len(vad_buffer) >= VAD_FRAME_SIZE:
-                        vad_frame = vad_buffer[:VAD_FRAME_SIZE]
-                        vad_buffer = vad_buffer[VAD_FRAME_SIZE:]
-                        
-                        if is_speech(vad_frame, vad):
-                            silence_counter = 0
-                        else:
-                            silence_counter += 1
-                            if silence_counter > SILENCE_FRAMES:
-                                print("[Silence detected. Stopping recording.]")
-                                break
+                    # Process VAD over every complete 30ms window (480 samples) at once
+                    n_windows = (write_pos - vad_pos) // VAD_FRAME_SIZE
+                    if n_windows:
+                        windows = audio_buffer[vad_pos:vad_pos + n_windows * VAD_FRAME_SIZE]
+                        vad_pos += n_windows * VAD_FRAME_SIZE
+
+                        for speech in speech_flags(windows.reshape(n_windows, VAD_FRAME_SIZE), vad):
+                            if speech:
+                                silence_counter = 0
+                            else:
+                                silence_counter += 1
+                                if silence_counter > SILENCE_FRAMES:
+                                    print("[Silence detected. Stopping recording.]")
+                                    break
                     
                     if silence_counter > SILENCE_FRAMES:
                         break
+                else:
+                    print(f"[Reached {MAX_RECORD_SECONDS}s limit. Stopping recording.]")
 
-                audio = np.concatenate(frames).astype(np.int16)
+                audio = audio_buffer[:write_pos]
 
                 with wave.open(OUTPUT_WAV, 'wb') as wf:
                     wf.setnchannels(1)
                     wf.setsampwidth(2)
                     wf.setframerate(SAMPLE_RATE)
-                    wf.writeframes(audio.tobytes())
+                    # The contiguous buffer slice is written as-is; no tobytes() copy
+                    wf.writeframes(audio)
 
                 print(f"[Audio saved to {OUTPUT_WAV}]")
                 
@@ -111,6 +228,8 @@ def record_after_wake():
                 silence_frame = np.zeros(OWW_FRAME_LENGTH, dtype=np.int16)
                 for _ in range(cooldown_frames_to_flush):
                     oww_model.predict(silence_frame)
+                # The pre-roll predates the recording; don't replay it
+                frames_fed = frames_seen
                 
                 print("[Resuming wake word detection...]\n")
                 # Continue listening for next wake word (don't break)
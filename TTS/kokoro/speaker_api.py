@@ -2,20 +2,26 @@
 Speaker API
 -----------
 Runs a lightweight FastAPI server that accepts uploaded WAV or MP3 files and
-plays them inside the container using any available CLI audio player.
+plays them inside the container through a persistent PortAudio output stream.
 """
 
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
-import shutil
-import subprocess
+import threading
 import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Sequence
+from typing import Dict, Tuple
 
-from fastapi import FastAPI, File, HTTPException, Request, UploadFile
-from fastapi.responses import JSONResponse
+import aiofiles
+import av
+import numpy as np
+import sounddevice as sd
+from fastapi import BackgroundTasks, FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import ORJSONResponse
 
 SUPPORTED_SUFFIXES = {".wav", ".mp3"}
 SUPPORTED_MIME_TYPES = {
@@ -25,70 +31,90 @@ SUPPORTED_MIME_TYPES = {
     "audio/mp3": ".mp3",
 }
 RECEIVED_DIR = Path(os.environ.get("RECEIVED_AUDIO_DIR", "received_audio"))
-PLAYER_ENV = os.environ.get("SPEAKER_PLAYER", "").strip()
+# Large reads amortise per-call overhead; file writes run off the event loop
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# Max time (seconds) to receive a whole streamed body before giving up
+BODY_TIMEOUT = float(os.environ.get("BS_BODY_TIMEOUT", "30"))
+# Kokoro renders 24 kHz mono; the stream for this format is opened at startup
+DEFAULT_SAMPLE_RATE = int(os.environ.get("SPEAKER_SAMPLE_RATE", "24000"))
+DEFAULT_CHANNELS = int(os.environ.get("SPEAKER_CHANNELS", "1"))
 
-PLAYER_CANDIDATES: List[List[str]] = [
-    ["ffplay", "-nodisp", "-autoexit"],
-    ["aplay"],
-    ["paplay"],
-]
+logger = logging.getLogger(__name__)
 
-FFMPEG_CMD = shutil.which("ffmpeg")
+# Output streams stay open for the life of the process, keyed by
+# (sample_rate, channels); opening the device per request costs far more
+# than short TTS clips take to play.
+_output_streams: Dict[Tuple[int, int], sd.OutputStream] = {}
+_playback_lock = threading.Lock()
 
-app = FastAPI(title="Kokoro Speaker API", version="1.0.0")
 
-_player_cmd: List[str] | None = None
-
-
-def _split_env_cmd(cmd_str: str) -> List[str]:
-    """Split SPEAKER_PLAYER env command respecting quotes."""
-    import shlex
-
-    return shlex.split(cmd_str)
-
-
-def _resolve_player() -> List[str]:
-    """Determine which playback command is available inside the container."""
-    candidates: Sequence[List[str]]
-
-    if PLAYER_ENV:
-        candidates = [_split_env_cmd(PLAYER_ENV)]
-    else:
-        candidates = PLAYER_CANDIDATES
+def _ensure_tmp_dir() -> None:
+    RECEIVED_DIR.mkdir(parents=True, exist_ok=True)
 
-    for candidate in candidates:
-        if shutil.which(candidate[0]):
-            return list(candidate)
 
-    raise RuntimeError(
-        "No audio player found. Install ffmpeg (for ffplay) or alsa-utils (aplay) "
-        "or provide SPEAKER_PLAYER env var."
-    )
+def _advise_sequential(buffer) -> None:
+    """Hint the kernel that an upload file is written/read front to back."""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(buffer.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
 
-def _ensure_tmp_dir() -> None:
-    RECEIVED_DIR.mkdir(parents=True, exist_ok=True)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _ensure_tmp_dir()
+    # Opening the device can take tens of ms; do it before traffic arrives
+    await asyncio.to_thread(_get_output_stream, DEFAULT_SAMPLE_RATE, DEFAULT_CHANNELS)
+    yield
+    with _playback_lock:
+        for stream in _output_streams.values():
+            stream.close()
+        _output_streams.clear()
+
+
+def _get_output_stream(sample_rate: int, channels: int) -> sd.OutputStream:
+    """Return the long-lived output stream for a format, opening it on first use."""
+    key = (sample_rate, channels)
+    stream = _output_streams.get(key)
+    if stream is None:
+        stream = sd.OutputStream(samplerate=sample_rate, channels=channels, dtype="int16")
+        stream.start()
+        _output_streams[key] = stream
+    return stream
+
+
+def _decode_audio(source: Path) -> Tuple[np.ndarray, int]:
+    """Decode a WAV or MP3 to interleaved int16 PCM in-process with libavcodec (PyAV).
+
+    Returns a (frames, channels) array and its sample rate.
+    """
+    try:
+        with av.open(str(source)) as container:
+            stream = container.streams.audio[0]
+            channels = len(stream.layout.channels)
+            resampler = av.AudioResampler(
+                format="s16", layout=stream.layout.name, rate=stream.rate
+            )
 
+            chunks = []
+            for frame in container.decode(stream):
+                chunks.extend(pcm.to_ndarray() for pcm in resampler.resample(frame))
+            chunks.extend(pcm.to_ndarray() for pcm in resampler.resample(None))
+    except (av.error.FFmpegError, IndexError) as exc:
+        raise HTTPException(status_code=400, detail=f"Could not decode audio: {exc}") from exc
 
-def _needs_wav_conversion(player_cmd: Sequence[str], suffix: str) -> bool:
-    return player_cmd and player_cmd[0] in {"aplay"} and suffix == ".mp3"
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Audio file contains no samples.")
 
+    # Packed s16 frames come back as (1, samples * channels)
+    pcm = np.concatenate(chunks, axis=1).reshape(-1, channels)
+    return pcm, stream.rate
 
-def _convert_to_wav(source: Path) -> Path:
-    if not FFMPEG_CMD:
-        raise RuntimeError(
-            "MP3 playback requires ffmpeg when using aplay. Install ffmpeg "
-            "or set SPEAKER_PLAYER to ffplay."
-        )
 
-    wav_path = source.with_suffix(".wav")
-    subprocess.run(
-        [FFMPEG_CMD, "-y", "-i", str(source), str(wav_path)],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-        check=True,
-    )
-    return wav_path
+app = FastAPI(
+    title="Kokoro Speaker API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 async def _store_upload(upload: UploadFile) -> Path:
@@ -106,14 +132,17 @@ async def _store_upload(upload: UploadFile) -> Path:
     tmp_name = f"{uuid.uuid4().hex}{suffix}"
     tmp_path = RECEIVED_DIR / tmp_name
 
-    with tmp_path.open("wb") as buffer:
+    bytes_written = 0
+    async with aiofiles.open(tmp_path, "wb") as buffer:
+        _advise_sequential(buffer)
         while True:
-            chunk = await upload.read(1024 * 1024)
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
             if not chunk:
                 break
-            buffer.write(chunk)
+            await buffer.write(chunk)
+            bytes_written += len(chunk)
 
-    if tmp_path.stat().st_size == 0:
+    if bytes_written == 0:
         tmp_path.unlink(missing_ok=True)
         raise HTTPException(status_code=400, detail="Uploaded file is empty.")
 
@@ -136,12 +165,33 @@ async def _store_stream(request: Request) -> Path:
     tmp_path = RECEIVED_DIR / tmp_name
 
     bytes_written = 0
-    with tmp_path.open("wb") as buffer:
-        async for chunk in request.stream():
-            if not chunk:
-                continue
-            buffer.write(chunk)
-            bytes_written += len(chunk)
+    body = request.stream()
+    loop = asyncio.get_running_loop()
+    # One deadline for the whole body, so slow but steady clients still finish
+    deadline = loop.time() + BODY_TIMEOUT
+    try:
+        async with aiofiles.open(tmp_path, "wb") as buffer:
+            _advise_sequential(buffer)
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        body.__anext__(), max(0.0, deadline - loop.time())
+                    )
+                except StopAsyncIteration:
+                    break
+                if not chunk:
+                    continue
+                await buffer.write(chunk)
+                bytes_written += len(chunk)
+    except asyncio.TimeoutError as exc:
+        tmp_path.unlink(missing_ok=True)
+        raise HTTPException(
+            status_code=408, detail="Timed out waiting for request body."
+        ) from exc
+    except BaseException:
+        # Client disconnects and write errors must not leave a partial file
+        tmp_path.unlink(missing_ok=True)
+        raise
 
     if bytes_written == 0:
         tmp_path.unlink(missing_ok=True)
@@ -150,43 +200,27 @@ async def _store_stream(request: Request) -> Path:
     return tmp_path
 
 
-def _play_file(file_path: Path, player_cmd: Sequence[str]) -> None:
-    target_path = file_path
-    converted_path: Path | None = None
-
-    if _needs_wav_conversion(player_cmd, file_path.suffix.lower()):
-        converted_path = _convert_to_wav(file_path)
-        target_path = converted_path
-
+def _play_pcm(pcm: np.ndarray, sample_rate: int) -> None:
+    """Blocking write of decoded PCM; runs as a background task after the response."""
     try:
-        subprocess.run(
-            list(player_cmd) + [str(target_path)],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-    except subprocess.CalledProcessError as exc:
-        raise HTTPException(status_code=500, detail=f"Playback failed: {exc}") from exc
-    finally:
-        if converted_path and converted_path.exists():
-            converted_path.unlink(missing_ok=True)
-
-
-@app.on_event("startup")
-def startup_event() -> None:
-    global _player_cmd
-    _ensure_tmp_dir()
-    _player_cmd = _resolve_player()
+        with _playback_lock:
+            _get_output_stream(sample_rate, pcm.shape[1]).write(pcm)
+    except sd.PortAudioError:
+        logger.exception("Playback failed")
 
 
 @app.get("/healthz")
 async def healthz():
-    return {"status": "ok", "player": _player_cmd[0] if _player_cmd else None}
+    return {"status": "ok", "player": "sounddevice" if _output_streams else None}
 
 
 @app.post("/play")
-async def play_audio(request: Request, file: UploadFile | None = File(None)):
-    if _player_cmd is None:
+async def play_audio(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    file: UploadFile | None = File(None),
+):
+    if not _output_streams:
         raise HTTPException(status_code=503, detail="Audio player not ready")
 
     if file is not None:
@@ -194,12 +228,16 @@ async def play_audio(request: Request, file: UploadFile | None = File(None)):
     else:
         stored_path = await _store_stream(request)
 
+    # Decode before responding so bad audio still gets a 400; the file is no
+    # longer needed once the PCM is in memory
     try:
-        _play_file(stored_path, _player_cmd)
+        pcm, sample_rate = await asyncio.to_thread(_decode_audio, stored_path)
     finally:
         stored_path.unlink(missing_ok=True)
 
-    return JSONResponse({"status": "played"})
+    # Playback runs in the threadpool after the response has been sent
+    background_tasks.add_task(_play_pcm, pcm, sample_rate)
+    return ORJSONResponse({"status": "queued"})
 
 
 if __name__ == "__main__":
@@ -1,47 +1,87 @@
-import tempfile
-import os
+import asyncio
+import io
 import wave
 import platform
-import subprocess
+import threading
 import traceback
+from contextlib import asynccontextmanager
 
+import numpy as np
+import sounddevice as sd
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from piper import PiperVoice
 import uvicorn
 
-app = FastAPI()
-
 MODEL_PATH =  r"C:\Users\Elyas\OneDrive - The University of Colorado Denver\Desktop\projects\black-synapse-ingestion\TTS\en_US-lessac-medium.onnx"
 
 VOICE: PiperVoice | None = None
 
+# Resolved once at import rather than on every playback
+IS_WINDOWS = platform.system().lower().startswith("win")
+if IS_WINDOWS:
+    import winsound
+
 
 class TTSRequest(BaseModel):
     text: str
 
 
-def play_wav(path: str):
-    system = platform.system().lower()
-    if "windows" in system:
-        import winsound
-        winsound.PlaySound(path, winsound.SND_FILENAME)
+# Long-lived output stream per (sample_rate, channels); replaces forking aplay
+# and reopening the ALSA device for every clip
+_output_streams = {}
+_playback_lock = threading.Lock()
+
+
+def get_output_stream(sample_rate: int, channels: int):
+    key = (sample_rate, channels)
+    stream = _output_streams.get(key)
+    if stream is None:
+        stream = sd.OutputStream(samplerate=sample_rate, channels=channels, dtype="int16")
+        stream.start()
+        _output_streams[key] = stream
+    return stream
+
+
+def play_wav(data: bytes):
+    if IS_WINDOWS:
+        winsound.PlaySound(data, winsound.SND_MEMORY)
     else:
-        subprocess.run(["aplay", path], check=True)
+        with wave.open(io.BytesIO(data), "rb") as wf:
+            channels = wf.getnchannels()
+            rate = wf.getframerate()
+            pcm = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+        with _playback_lock:
+            get_output_stream(rate, channels).write(pcm.reshape(-1, channels))
 
 
-@app.on_event("startup")
-def load_voice():
-    global VOICE
+def load_voice() -> PiperVoice | None:
     try:
         use_cuda = True
-        VOICE = PiperVoice.load(MODEL_PATH, use_cuda=use_cuda)
+        voice = PiperVoice.load(MODEL_PATH, use_cuda=use_cuda)
         print(f"Piper model loaded on {'GPU' if use_cuda else 'CPU'}")
+        # One throwaway synth so the first request doesn't pay ONNX session
+        # and CUDA kernel warmup
+        with wave.open(io.BytesIO(), "wb") as wav_file:
+            voice.synthesize_wav("warmup", wav_file)
+        return voice
     except Exception as e:
         print("Failed to load Piper model:", e)
         traceback.print_exc()
         # let it start anyway, but endpoints will 500
-        VOICE = None
+        return None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global VOICE
+    VOICE = await asyncio.to_thread(load_voice)
+    yield
+    for stream in _output_streams.values():
+        stream.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/tts")
@@ -49,31 +89,25 @@ def tts(req: TTSRequest):
     if VOICE is None:
         raise HTTPException(status_code=500, detail="Voice model not loaded")
 
-    # make temp wav
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-        tmp_path = tmp.name
-
-    # synthesize
+    # synthesize into memory; playback reads the same buffer, so the PCM never
+    # touches disk
+    buf = io.BytesIO()
     try:
-        with wave.open(tmp_path, "wb") as wav_file:
+        with wave.open(buf, "wb") as wav_file:
             VOICE.synthesize_wav(req.text, wav_file)
     except Exception as e:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
         print("TTS failed:", e)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"TTS failed: {e}")
 
     # play
     try:
-        play_wav(tmp_path)
+        play_wav(buf.getvalue())
     except Exception as e:
-        os.remove(tmp_path)
         print("Playback failed:", e)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Playback failed: {e}")
 
-    os.remove(tmp_path)
     return {"status": "played", "text": req.text}
 
 
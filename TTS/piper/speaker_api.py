@@ -1,21 +1,56 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 import base64
-import subprocess
-import tempfile
-import os
+import io
+import logging
+import threading
+import wave
+import numpy as np
+import sounddevice as sd
 
-app = FastAPI()
-PLAYER_CMD = ["aplay"]  # or ["ffplay", "-nodisp", "-autoexit"]
+app = FastAPI(default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
+
+# Output streams stay open for the life of the process, keyed by
+# (sample_rate, channels), so a clip costs a buffer write instead of an
+# aplay fork plus an ALSA device open
+_output_streams = {}
+_playback_lock = threading.Lock()
 
 # Expected request body:
 # { "data": "<base64 or raw string of wav bytes>" }
 class AudioData(BaseModel):
     data: str
 
+def get_output_stream(sample_rate, channels):
+    key = (sample_rate, channels)
+    stream = _output_streams.get(key)
+    if stream is None:
+        stream = sd.OutputStream(samplerate=sample_rate, channels=channels, dtype="int16")
+        stream.start()
+        _output_streams[key] = stream
+    return stream
+
+def decode_wav_bytes(audio_bytes):
+    """Return (pcm, sample_rate) with pcm shaped (frames, channels) int16."""
+    with wave.open(io.BytesIO(audio_bytes), "rb") as wf:
+        if wf.getsampwidth() != 2:
+            raise ValueError(f"Expected 16-bit PCM, got {wf.getsampwidth() * 8}-bit")
+        channels = wf.getnchannels()
+        rate = wf.getframerate()
+        pcm = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+    return pcm.reshape(-1, channels), rate
+
+def play_pcm(pcm, sample_rate):
+    try:
+        with _playback_lock:
+            get_output_stream(sample_rate, pcm.shape[1]).write(pcm)
+    except Exception:
+        logger.exception("Playback failed")
+
 @app.post("/incoming-audio")
-async def incoming_audio(payload: AudioData):
+async def incoming_audio(payload: AudioData, background_tasks: BackgroundTasks):
     """
     Accepts a JSON body with 'data' containing base64-encoded audio.
     Example body: { "data": "<base64 string>" }
@@ -26,17 +61,12 @@ async def incoming_audio(payload: AudioData):
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid base64 audio data")
 
-    # Save bytes to a temporary WAV file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-        tmp.write(audio_bytes)
-        tmp_path = tmp.name
-
-    # Play the audio
     try:
-        subprocess.run(PLAYER_CMD + [tmp_path], check=True)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Playback failed: {e}")
-    finally:
-        os.remove(tmp_path)
+        pcm, rate = decode_wav_bytes(audio_bytes)
+    except (wave.Error, EOFError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid WAV audio: {e}")
 
-    return JSONResponse({"status": "played"})
\ No newline at end of file
+    # Respond right away; the blocking stream write runs in the threadpool
+    # after the response is sent
+    background_tasks.add_task(play_pcm, pcm, rate)
+    return ORJSONResponse({"status": "queued"})
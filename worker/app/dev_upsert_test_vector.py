@@ -4,8 +4,8 @@ This file is placed under `worker/app/` so it's included in the Docker image.
 """
 import os
 import sys
-import json
 import numpy as np
+import orjson
 from qdrant_client import QdrantClient
 
 from app.utils import validate_vector
@@ -21,7 +21,8 @@ def main():
     qc = QdrantClient(url=qdrant_url)
 
     # Create a random vector for testing
-    vec = np.random.rand(dim).astype(float)
+    # float32 matches the collection's storage; float64 would only be narrowed
+    vec = np.random.rand(dim).astype(np.float32)
 
     # validate
     try:
@@ -32,10 +33,14 @@ def main():
 
     import uuid
 
+    # The client's models take plain lists; convert once and reuse for the
+    # upsert and the search below
+    vec_list = vec.tolist()
+
     # Upsert a single point (use UUID for point id)
     point = {
         'id': str(uuid.uuid4()),
-        'vector': vec.tolist(),
+        'vector': vec_list,
         'payload': {'source': 'dev', 'note': 'test point'}
     }
 
@@ -50,22 +55,22 @@ def main():
     # qdrant_client version compatibility: if `search` is unavailable, fall back to HTTP API
     try:
         if hasattr(qc, 'search'):
-            hits = qc.search(collection_name=collection, query_vector=vec.tolist(), limit=5)
+            hits = qc.search(collection_name=collection, query_vector=vec_list, limit=5)
             results = [{'id': h.id, 'score': getattr(h, 'score', None), 'payload': h.payload} for h in hits]
         else:
             import urllib.request
             url = f"{qdrant_url.rstrip('/')}/collections/{collection}/points/search"
-            body = {"vector": vec.tolist(), "limit": 5, "with_payload": True}
-            req_data = json.dumps(body).encode('utf-8')
+            body = {"vector": vec_list, "limit": 5, "with_payload": True}
+            req_data = orjson.dumps(body)
             req = urllib.request.Request(url, data=req_data, headers={"Content-Type": "application/json"})
             with urllib.request.urlopen(req) as resp:
-                data = json.load(resp)
+                data = orjson.loads(resp.read())
             results = []
             for hit in data.get('result', []):
                 results.append({'id': hit.get('id'), 'score': hit.get('score'), 'payload': hit.get('payload')})
 
         print("Search results:")
-        print(json.dumps(results, indent=2))
+        print(orjson.dumps(results, option=orjson.OPT_INDENT_2).decode())
     except Exception as e:
         print(f"Search failed: {e}")
         sys.exit(4)
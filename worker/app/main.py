@@ -7,12 +7,16 @@ Handles ingestion, deduplication, chunking, and vector storage.
 
 import os
 import logging
+from contextlib import asynccontextmanager
 from typing import Dict, Any, List
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
 from dotenv import load_dotenv
+import orjson
 
+from .models import DocumentPayload
 from .pipeline import IngestionPipeline
 from .utils import setup_logging
 
@@ -23,11 +27,23 @@ load_dotenv()
 setup_logging()
 logger = logging.getLogger(__name__)
 
+# Initialize ingestion pipeline
+pipeline = IngestionPipeline()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize the pipeline before serving; flush and close it on shutdown."""
+    await pipeline.initialize()
+    yield
+    await pipeline.aclose()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Black Synapse Data Ingestion",
     description="ETL pipeline for processing and embedding data from various sources",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -39,21 +55,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize ingestion pipeline
-pipeline = IngestionPipeline()
-
 # Pydantic models for API requests/responses
-class DocumentPayload(BaseModel):
-    """Unified document schema for ingestion."""
-    doc_id: str = Field(..., description="Unique document identifier")
-    source: str = Field(..., description="Data source (e.g., 'notion', 'gmail', 'slack')")
-    title: str = Field(..., description="Document title")
-    uri: str = Field(..., description="Document URI or URL")
-    text: str = Field(..., description="Document content text")
-    author: str = Field(..., description="Document author")
-    created_at: str = Field(..., description="Creation timestamp (ISO format)")
-    updated_at: str = Field(..., description="Last update timestamp (ISO format)")
-
 class IngestionResponse(BaseModel):
     """Response model for ingestion operations."""
     success: bool
@@ -110,6 +112,7 @@ async def ingest_document(
     """
     try:
         logger.info(f"Processing document: {document.doc_id} from {document.source}")
+        await pipeline.ready.wait()
         
         # Process document through pipeline
         result = await pipeline.process_document(document)
@@ -148,6 +151,7 @@ async def reindex_document(
     """
     try:
         logger.info(f"Re-indexing document: {doc_id}")
+        await pipeline.ready.wait()
         
         # Retrieve document from database
         document = await pipeline.get_document_by_id(doc_id)
@@ -180,7 +184,7 @@ async def reindex_document(
         logger.error(f"Unexpected error re-indexing document {doc_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Re-indexing failed: {str(e)}")
 
-@app.post("/sync", response_model=SyncResponse)
+@app.post("/sync")
 async def sync_data_source(
     source: str,
     background_tasks: BackgroundTasks
@@ -192,25 +196,31 @@ async def sync_data_source(
     1. Processing all documents from the source
     2. Identifying and handling deletions
     3. Updating metadata
+    
+    Progress is streamed as NDJSON: one "document" event per processed
+    document, then a final "completed" (SyncResponse fields) or "failed"
+    event. Syncs of the same source are serialized.
     """
-    try:
-        logger.info(f"Starting full sync for source: {source}")
-        
-        # Perform full synchronization
-        result = await pipeline.sync_source(source)
-        
-        logger.info(f"Sync completed for {source}: {result['documents_processed']} processed, {result['documents_deleted']} deleted")
-        return SyncResponse(
-            success=True,
-            message=f"Sync completed for {source}",
-            documents_processed=result["documents_processed"],
-            documents_deleted=result["documents_deleted"],
-            errors=result.get("errors", [])
-        )
-        
-    except Exception as e:
-        logger.error(f"Sync failed for source {source}: {e}")
-        raise HTTPException(status_code=500, detail=f"Sync failed: {str(e)}")
+    logger.info(f"Starting full sync for source: {source}")
+    await pipeline.ready.wait()
+    
+    async def events():
+        async for event in pipeline.sync_source_stream(source):
+            if event["event"] == "completed":
+                logger.info(f"Sync completed for {source}: {event['documents_processed']} processed, {event['documents_deleted']} deleted")
+                event = {
+                    "event": "completed",
+                    **SyncResponse(
+                        success=True,
+                        message=f"Sync completed for {source}",
+                        documents_processed=event["documents_processed"],
+                        documents_deleted=event["documents_deleted"],
+                        errors=event["errors"]
+                    ).model_dump()
+                }
+            yield orjson.dumps(event) + b"\n"
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 if __name__ == "__main__":
     import uvicorn
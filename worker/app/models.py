@@ -0,0 +1,16 @@
+"""
+Shared data models for the ingestion worker.
+"""
+
+from pydantic import BaseModel, Field
+
+class DocumentPayload(BaseModel):
+    """Unified document schema for ingestion."""
+    doc_id: str = Field(..., description="Unique document identifier")
+    source: str = Field(..., description="Data source (e.g., 'notion', 'gmail', 'slack')")
+    title: str = Field(..., description="Document title")
+    uri: str = Field(..., description="Document URI or URL")
+    text: str = Field(..., description="Document content text")
+    author: str = Field(..., description="Document author")
+    created_at: str = Field(..., description="Creation timestamp (ISO format)")
+    updated_at: str = Field(..., description="Last update timestamp (ISO format)")
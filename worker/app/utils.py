@@ -4,148 +4,432 @@ Black Synapse Data Ingestion Utilities
 Utility functions for text processing, embedding generation, and logging.
 """
 
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import asyncio
-from typing import List, Dict, Any
-# `tiktoken` and `openai` are imported lazily inside functions that need them
+import inspect
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+from contextlib import aclosing
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Tuple, Union
 
 import tiktoken
 import openai
 import numpy as np
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+DEFAULT_ENCODING = "cl100k_base"
+# Token ids of recently encoded text blocks, shared across documents, so
+# re-ingesting a lightly edited document only encodes the blocks that changed.
+# Bounded by the total characters of the cached blocks (their id lists take
+# roughly 10x that in memory); a block longer than ENCODE_CACHE_MAX_BLOCK_CHARS,
+# such as a whole file without newlines, is encoded but not kept
+ENCODE_CACHE_MAX_CHARS = 2_000_000
+ENCODE_CACHE_MAX_BLOCK_CHARS = 64_000
+# Block boundary: a newline followed by non-whitespace. tiktoken's
+# pre-tokenizer never joins text across this point, so the ids of the blocks
+# concatenate to exactly the ids of the whole text
+_BLOCK_BOUNDARY_RE = re.compile(r'(?<=\n)(?=\S)')
+_encode_cache: "OrderedDict[Tuple[Any, str], List[int]]" = OrderedDict()
+_encode_cache_chars = 0
+_encode_cache_lock = threading.Lock()
+# OpenAI caps one embeddings request at 300k input tokens (and 2048 inputs)
+EMBED_REQUEST_MAX_TOKENS = 300_000
+# Embeddings of recently embedded inputs, keyed by (model, text or token ids),
+# so boilerplate chunks repeated across documents are only sent once
+# (~12 MB of 1536-d float32 rows)
+EMBED_CACHE_SIZE = 2048
+_embed_cache: "OrderedDict[Tuple[str, Any], np.ndarray]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+# Client-side throttles kept under the account's embeddings rate limits
+# (requests and tokens per minute), so large ingests run at the limit instead
+# of bouncing off 429s
+_RPM_LIMITER = AsyncLimiter(int(os.getenv("OPENAI_EMBED_RPM", "3000")), 60)
+_TPM_LIMITER = AsyncLimiter(int(os.getenv("OPENAI_EMBED_TPM", "1000000")), 60)
+REQUIRED_PAYLOAD_FIELDS = ("doc_id", "source", "title", "uri", "text", "author", "created_at", "updated_at")
+# (epoch second, its ISO string) for the last response timestamp
+_iso_second: Tuple[int, str] = (-1, "")
+# Sample encoded once per tokenizer to calibrate estimate_tokens
+_CALIBRATION_SAMPLE = (
+    "The ingestion worker splits each document into overlapping chunks, "
+    "embeds them, and stores the vectors with their metadata. "
+) * 20
+# UTF-8 bytes per token, keyed by tokenizer
+_bytes_per_token: Dict[Any, float] = {}
+# Control characters dropped by sanitize_text: C0 controls except newlines
+# and tabs, plus DEL
+_CONTROL_CHARS = dict.fromkeys([*(i for i in range(32) if chr(i) not in '\n\t'), 0x7f])
+
+@lru_cache(maxsize=8)
+def get_tokenizer(name_or_model: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    """
+    Load a tiktoken encoding once per process, warmed with a first encode.
+    
+    Args:
+        name_or_model: Encoding name (e.g. 'cl100k_base') or model name
+            (e.g. 'text-embedding-3-small')
+        
+    Returns:
+        Cached tokenizer instance
+    """
+    try:
+        encoding = tiktoken.get_encoding(name_or_model)
+    except ValueError:
+        encoding = tiktoken.encoding_for_model(name_or_model)
+    encoding.encode("warmup")
+    return encoding
+
+def encode_cached(text: str, tokenizer: Any = None) -> List[int]:
+    """
+    Tokenize text block by block, reusing ids of blocks seen recently.
+    
+    Args:
+        text: Input text
+        tokenizer: Tiktoken tokenizer instance (default: cached cl100k_base)
+        
+    Returns:
+        Token ids of the whole text, identical to tokenizer.encode_ordinary(text)
+    """
+    global _encode_cache_chars
+    tokenizer = tokenizer or get_tokenizer()
+    blocks = _BLOCK_BOUNDARY_RE.split(text)
+    
+    encoded: List[List[int]] = [None] * len(blocks)
+    misses: Dict[str, List[int]] = {}
+    with _encode_cache_lock:
+        for i, block in enumerate(blocks):
+            ids = _encode_cache.get((tokenizer, block))
+            if ids is None:
+                misses.setdefault(block, []).append(i)
+            else:
+                _encode_cache.move_to_end((tokenizer, block))
+                encoded[i] = ids
+    
+    if misses:
+        fresh = encode_many(tokenizer, list(misses))
+        with _encode_cache_lock:
+            for (block, positions), ids in zip(misses.items(), fresh):
+                for i in positions:
+                    encoded[i] = ids
+                if len(block) > ENCODE_CACHE_MAX_BLOCK_CHARS:
+                    continue
+                if (tokenizer, block) not in _encode_cache:
+                    _encode_cache_chars += len(block)
+                _encode_cache[(tokenizer, block)] = ids
+            while _encode_cache_chars > ENCODE_CACHE_MAX_CHARS:
+                (_, evicted), _ = _encode_cache.popitem(last=False)
+                _encode_cache_chars -= len(evicted)
+    
+    return [token for ids in encoded for token in ids]
 
 def setup_logging():
-    """Configure logging for the application."""
+    """
+    Configure logging for the application.
+    
+    Records are put on a queue and written to the console and a rotating log
+    file by a listener thread, so logging calls never wait on disk I/O.
+    Calling this again is a no-op.
+    """
+    root = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return
+    
     log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [
+        logging.StreamHandler(),
+        logging.handlers.RotatingFileHandler('ingestion.log', maxBytes=50_000_000, backupCount=3)
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
     
-    logging.basicConfig(
-        level=getattr(logging, log_level),
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler('ingestion.log')
-        ]
-    )
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Drains queued records before the interpreter exits
+    atexit.register(listener.stop)
+    
+    root.setLevel(getattr(logging, log_level))
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
 
-def chunk_text(text: str, tokenizer: Any, 
+def chunk_text(text: str, tokenizer: Any = None, 
                max_tokens: int = 500, overlap_tokens: int = 50) -> List[Dict[str, Any]]:
     """
     Chunk text into overlapping segments for embedding.
     
+    List form of iter_chunks, for callers that need every chunk at once.
+    """
+    return list(iter_chunks(text, tokenizer, max_tokens, overlap_tokens))
+
+def _chunk_ranges(n_tokens: int, max_tokens: int, overlap_tokens: int) -> np.ndarray:
+    """
+    Token [start, end) ranges of every chunk, as an (n_chunks, 2) array.
+    
+    Chunks advance by max_tokens - overlap_tokens and the last one ends at
+    n_tokens; an overlap of max_tokens or more is clamped so chunks still
+    advance by at least one token.
+    """
+    step = max_tokens - min(overlap_tokens, max_tokens - 1)
+    last = max(0, -(-(n_tokens - max_tokens) // step))
+    starts = np.arange(last + 1) * step
+    return np.column_stack((starts, np.minimum(starts + max_tokens, n_tokens)))
+
+def iter_chunks(text: str, tokenizer: Any = None, 
+                max_tokens: int = 500, overlap_tokens: int = 50) -> Iterator[Dict[str, Any]]:
+    """
+    Yield overlapping segments of text for embedding, one at a time.
+    
     Args:
         text: Input text to chunk
-        tokenizer: Tiktoken tokenizer instance
+        tokenizer: Tiktoken tokenizer instance (default: cached cl100k_base)
         max_tokens: Maximum tokens per chunk
         overlap_tokens: Number of tokens to overlap between chunks
         
-    Returns:
-        List of chunk dictionaries with 'text' and 'token_count' keys
+    Yields:
+        Chunk dictionaries with 'text', 'tokens' and 'token_count' keys;
+        'tokens' are the slice of the document's token ids that 'text' was
+        decoded from (before stripping), ready to send to the embeddings API
     """
-    if not text.strip():
-        return []
+    if not text or text.isspace():
+        return
+    
+    tokenizer = tokenizer or get_tokenizer()
     
-    # Tokenize the text
-    tokens = tokenizer.encode(text)
+    # Tokenize the text; unchanged blocks of a re-ingested document hit the cache
+    tokens = encode_cached(text, tokenizer)
     
     if len(tokens) <= max_tokens:
-        return [{
+        yield {
             "text": text,
+            "tokens": tokens,
             "token_count": len(tokens)
-        }]
+        }
+        return
     
-    chunks = []
-    start = 0
+    # Byte strings for every token, decoded once; overlapping chunks slice
+    # this instead of decoding their tokens again
+    all_token_bytes = tokenizer.decode_tokens_bytes(tokens)
     
-    while start < len(tokens):
-        # Calculate end position
-        end = min(start + max_tokens, len(tokens))
-        
+    for start, end in _chunk_ranges(len(tokens), max_tokens, overlap_tokens).tolist():
         # Extract chunk tokens
         chunk_tokens = tokens[start:end]
+        token_bytes = all_token_bytes[start:end]
         
-        # Decode back to text
-        chunk_text = tokenizer.decode(chunk_tokens)
-        
-        # Clean up chunk text (remove partial words at boundaries)
+        # Clean up chunk boundaries (remove partial words) on the token ids:
+        # a token starting with a space begins a new word. Slicing the ids
+        # keeps them and token_count exact without re-encoding the chunk.
+        first, last = 0, len(chunk_tokens)
         if start > 0:  # Not the first chunk
             # Find the first complete word boundary
-            first_space = chunk_text.find(' ')
-            if first_space > 0:
-                chunk_text = chunk_text[first_space + 1:]
+            first = next((i for i in range(last) if token_bytes[i][:1] == b' '), 0)
         
         if end < len(tokens):  # Not the last chunk
             # Find the last complete word boundary
-            last_space = chunk_text.rfind(' ')
-            if last_space > 0:
-                chunk_text = chunk_text[:last_space]
-        
-        if chunk_text.strip():
-            chunks.append({
-                "text": chunk_text.strip(),
-                "token_count": len(tokenizer.encode(chunk_text))
-            })
-        
-        # Move start position with overlap
-        start = end - overlap_tokens
+            last = next((i for i in range(last - 1, first, -1) if token_bytes[i][:1] == b' '), last)
         
-        # Prevent infinite loop
-        if start >= len(tokens) - overlap_tokens:
-            break
+        chunk_ids = chunk_tokens[first:last]
+        chunk_text = b"".join(token_bytes[first:last]).decode("utf-8", errors="replace").strip()
+        if chunk_text:
+            yield {
+                "text": chunk_text,
+                "tokens": chunk_ids,
+                "token_count": len(chunk_ids)
+            }
+
+def _pack_batches(lengths: List[int], max_tokens: int, max_items: int) -> List[List[int]]:
+    """
+    Group input indices into request batches by first-fit decreasing.
+    
+    Longest inputs are placed first, each into the first batch with room for
+    it, so batches fill close to max_tokens and similar lengths share a request.
     
-    return chunks
+    Args:
+        lengths: Token length of each input
+        max_tokens: Token budget per batch
+        max_items: Maximum inputs per batch
+        
+    Returns:
+        Lists of input indices, one per batch
+    """
+    batches: List[List[int]] = []
+    totals: List[int] = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+        for b, total in enumerate(totals):
+            if total + lengths[i] <= max_tokens and len(batches[b]) < max_items:
+                batches[b].append(i)
+                totals[b] += lengths[i]
+                break
+        else:
+            batches.append([i])
+            totals.append(lengths[i])
+    return batches
 
-async def get_embedding(texts: List[str], openai_client: Any, 
-                       model: str = "text-embedding-3-small") -> List[List[float]]:
+async def iter_embeddings(texts: Union[List[str], List[List[int]]], openai_client: Any, 
+                          model: str = "text-embedding-3-small", batch_size: int = 256,
+                          max_tokens: int = EMBED_REQUEST_MAX_TOKENS, max_concurrency: int = 5,
+                          semaphore: Optional[asyncio.Semaphore] = None
+                          ) -> AsyncIterator[Tuple[List[int], np.ndarray]]:
     """
-    Generate embeddings for a list of texts using OpenAI's embedding API.
+    Generate embeddings request by request, yielding each as it completes.
+    
+    Inputs embedded recently are served from a cache and yielded first;
+    the rest, each distinct input once, are packed into requests of at most
+    batch_size inputs and max_tokens tokens (see _pack_batches) that all
+    start at once. Each response is yielded as soon as it arrives, so callers
+    can store results while the remaining requests are still in flight.
     
     Args:
-        texts: List of texts to embed
+        texts: List of texts to embed, or their token-id lists (the API accepts
+            pre-tokenized input, which skips server-side tokenization)
         openai_client: OpenAI client instance
         model: Embedding model to use
+        batch_size: Maximum inputs per request
+        max_tokens: Maximum input tokens per request
+        max_concurrency: Requests in flight when no semaphore is given
+        semaphore: Shared semaphore bounding requests across callers
         
-    Returns:
-        List of embedding vectors
+    Yields:
+        (indices into texts, float32 array with one embedding row per index)
     """
     if not texts:
-        return []
+        return
     
+    keys = [(model, t if isinstance(t, str) else tuple(t)) for t in texts]
+    cached_indices: List[int] = []
+    cached_rows: List[np.ndarray] = []
+    # Positions of each input still to embed; duplicates share one request slot
+    pending: Dict[Tuple[str, Any], List[int]] = {}
+    with _embed_cache_lock:
+        for i, key in enumerate(keys):
+            row = _embed_cache.get(key)
+            if row is None:
+                pending.setdefault(key, []).append(i)
+            else:
+                _embed_cache.move_to_end(key)
+                cached_indices.append(i)
+                cached_rows.append(row)
+    
+    if cached_indices:
+        yield cached_indices, np.stack(cached_rows)
+    if not pending:
+        return
+    
+    semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+    create = openai_client.embeddings.create
+    
+    # A 429 or dropped connection that slips past the limiters is retried
+    # with jittered exponential backoff
+    @retry(
+        retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError)),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(6),
+        reraise=True
+    )
+    async def embed_batch(batch, tokens):
+        async with semaphore:
+            await _RPM_LIMITER.acquire()
+            await _TPM_LIMITER.acquire(min(max(tokens, 1), _TPM_LIMITER.max_rate))
+            # AsyncOpenAI is awaited directly; a sync client runs in a worker thread
+            if inspect.iscoroutinefunction(create):
+                return batch, await create(model=model, input=[texts[i] for i in batch])
+            return batch, await asyncio.to_thread(create, model=model, input=[texts[i] for i in batch])
+    
+    # First position of each distinct input; token-id inputs have exact
+    # lengths, text is estimated
+    unique = [positions[0] for positions in pending.values()]
+    lengths = [len(texts[i]) if isinstance(texts[i], list) else estimate_tokens(texts[i]) for i in unique]
+    tasks = [
+        asyncio.create_task(embed_batch([unique[j] for j in packed], sum(lengths[j] for j in packed)))
+        for packed in _pack_batches(lengths, max_tokens, batch_size)
+    ]
+    dim = None
     try:
-        # OpenAI API supports batching, so we can process all texts at once
-        response = await asyncio.to_thread(
-            openai_client.embeddings.create,
-            model=model,
-            input=texts
-        )
-        
-        # Extract embeddings from response
-        embeddings = [data.embedding for data in response.data]
-        
-        # Validate that we got the expected number of embeddings
-        if len(embeddings) != len(texts):
-            error_msg = f"Embedding count mismatch: expected {len(texts)} embeddings, got {len(embeddings)}"
-            logging.error(error_msg)
-            raise ValueError(error_msg)
-        
-        # Validate embedding dimensions (log warning if unexpected)
-        if embeddings:
-            dim = len(embeddings[0])
-            expected_dims = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
-            if model in expected_dims and dim != expected_dims[model]:
-                logging.warning(f"Unexpected embedding dimension for {model}: expected {expected_dims[model]}, got {dim}")
-            # Verify all embeddings have the same dimension
-            for i, emb in enumerate(embeddings):
-                if len(emb) != dim:
-                    error_msg = f"Embedding dimension mismatch at index {i}: expected {dim}, got {len(emb)}"
+        for next_done in asyncio.as_completed(tasks):
+            batch, response = await next_done
+            
+            # Validate that we got the expected number of embeddings
+            if len(response.data) != len(batch):
+                error_msg = f"Embedding count mismatch: expected {len(batch)} embeddings, got {len(response.data)}"
+                logging.error(error_msg)
+                raise ValueError(error_msg)
+            
+            if dim is None:
+                dim = len(response.data[0].embedding)
+                # Validate embedding dimensions (log warning if unexpected)
+                expected_dims = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+                if model in expected_dims and dim != expected_dims[model]:
+                    logging.warning(f"Unexpected embedding dimension for {model}: expected {expected_dims[model]}, got {dim}")
+            
+            # Pack rows straight into a float32 matrix: 6 KB per 1536-d vector
+            # instead of ~45 KB as a list of Python floats
+            embeddings = np.empty((len(batch), dim), dtype=np.float32)
+            for row, (i, item) in enumerate(zip(batch, response.data)):
+                # Verify all embeddings have the same dimension
+                if len(item.embedding) != dim:
+                    error_msg = f"Embedding dimension mismatch at index {i}: expected {dim}, got {len(item.embedding)}"
                     logging.error(error_msg)
                     raise ValueError(error_msg)
-        
-        logging.info(f"Successfully generated {len(embeddings)} embeddings using model {model}")
-        return embeddings
+                embeddings[row] = item.embedding
+            
+            with _embed_cache_lock:
+                for i, row in zip(batch, embeddings):
+                    _embed_cache[keys[i]] = row.copy()
+                while len(_embed_cache) > EMBED_CACHE_SIZE:
+                    _embed_cache.popitem(last=False)
+            
+            # Repeated inputs get a copy of their row at every position
+            counts = [len(pending[keys[i]]) for i in batch]
+            if len(counts) != sum(counts):
+                batch = [p for i in batch for p in pending[keys[i]]]
+                embeddings = np.repeat(embeddings, counts, axis=0)
+            
+            yield batch, embeddings
         
     except Exception as e:
         logging.error(f"Failed to generate embeddings: {e}")
         raise
+    finally:
+        # Requests still running when the caller stops early are abandoned
+        for task in tasks:
+            task.cancel()
+
+async def get_embedding(texts: Union[List[str], List[List[int]]], openai_client: Any, 
+                       model: str = "text-embedding-3-small", batch_size: int = 256,
+                       max_tokens: int = EMBED_REQUEST_MAX_TOKENS, max_concurrency: int = 5,
+                       semaphore: Optional[asyncio.Semaphore] = None) -> np.ndarray:
+    """
+    Generate embeddings for a list of texts using OpenAI's embedding API.
+    
+    Collects iter_embeddings into one matrix in input order; see it for
+    batching and the arguments.
+    
+    Returns:
+        float32 array of shape (len(texts), dim), one embedding per row
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    
+    embeddings = None
+    async with aclosing(iter_embeddings(
+        texts, openai_client, model=model, batch_size=batch_size, max_tokens=max_tokens,
+        max_concurrency=max_concurrency, semaphore=semaphore
+    )) as batches:
+        async for indices, batch_embeddings in batches:
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+            # Each row goes back to its input's position
+            embeddings[indices] = batch_embeddings
+    
+    logging.info(f"Successfully generated {len(embeddings)} embeddings using model {model}")
+    return embeddings
 
 def validate_document_payload(payload: Dict[str, Any]) -> List[str]:
     """
@@ -159,12 +443,14 @@ def validate_document_payload(payload: Dict[str, Any]) -> List[str]:
     """
     errors = []
     
-    required_fields = ["doc_id", "source", "title", "uri", "text", "author", "created_at", "updated_at"]
-    
-    for field in required_fields:
+    for field in REQUIRED_PAYLOAD_FIELDS:
         if field not in payload:
             errors.append(f"Missing required field: {field}")
-        elif not payload[field] or (isinstance(payload[field], str) and not payload[field].strip()):
+            continue
+        value = payload[field]
+        # isspace() stops at the first non-blank character; strip() would
+        # copy the whole document text just to test it for emptiness
+        if not value or (isinstance(value, str) and value.isspace()):
             errors.append(f"Empty value for required field: {field}")
     
     # Validate doc_id format (should be non-empty string)
@@ -176,16 +462,28 @@ def validate_document_payload(payload: Dict[str, Any]) -> List[str]:
         errors.append("source must be a string")
     
     # Validate timestamps (basic ISO format check)
-    for timestamp_field in ["created_at", "updated_at"]:
+    for timestamp_field in ("created_at", "updated_at"):
         if timestamp_field in payload:
             try:
-                from datetime import datetime
                 datetime.fromisoformat(payload[timestamp_field].replace('Z', '+00:00'))
             except (ValueError, AttributeError):
                 errors.append(f"Invalid timestamp format for {timestamp_field}")
     
     return errors
 
+def _utc_now_iso() -> str:
+    """Current UTC time in ISO format; the date/time part is formatted once per second."""
+    global _iso_second
+    now = time.time()
+    second = int(now)
+    cached_second, prefix = _iso_second
+    if second != cached_second:
+        prefix = datetime.fromtimestamp(second, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        _iso_second = (second, prefix)
+    # Same shape as naive isoformat(): no offset, microseconds only when nonzero
+    microsecond = int((now - second) * 1_000_000)
+    return f"{prefix}.{microsecond:06d}" if microsecond else prefix
+
 def format_api_response(success: bool, message: str, **kwargs) -> Dict[str, Any]:
     """
     Format a standardized API response.
@@ -198,37 +496,65 @@ def format_api_response(success: bool, message: str, **kwargs) -> Dict[str, Any]
     Returns:
         Formatted response dictionary
     """
-    from datetime import datetime
-    
     response = {
         "success": success,
         "message": message,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _utc_now_iso()
     }
     
     response.update(kwargs)
     return response
 
-def calculate_text_similarity(text1: str, text2: str, tokenizer: Any) -> float:
+def encode_many(tokenizer: Any, texts: List[str], num_threads: int = 8) -> List[List[int]]:
+    """
+    Tokenize several texts in one call.
+    
+    tiktoken's encode_ordinary_batch spreads the texts over a thread pool in
+    its Rust core, instead of one GIL round-trip per text. Special-token
+    strings such as "<|endoftext|>" are encoded as plain text rather than
+    rejected, and the per-text scan for them is skipped.
+    
+    Args:
+        tokenizer: Tiktoken tokenizer instance
+        texts: Texts to tokenize
+        num_threads: Worker threads for the batch
+        
+    Returns:
+        Token ids for each text, in input order
+    """
+    if not texts:
+        return []
+    return tokenizer.encode_ordinary_batch(texts, num_threads=num_threads)
+
+def calculate_text_similarity(text1: str, text2: str, tokenizer: Any = None) -> float:
     """
     Calculate similarity between two texts using token overlap.
     
     Args:
         text1: First text
         text2: Second text
-        tokenizer: Tiktoken tokenizer instance
+        tokenizer: Tiktoken tokenizer instance (default: cached cl100k_base)
         
     Returns:
         Similarity score between 0 and 1
     """
-    tokens1 = set(tokenizer.encode(text1))
-    tokens2 = set(tokenizer.encode(text2))
+    # Only the empty string tokenizes to nothing, and equal texts have equal
+    # token sets, so both cases are decided without tokenizing
+    if not text1 or not text2:
+        return 0.0
+    if text1 == text2:
+        return 1.0
     
-    if not tokens1 or not tokens2:
+    ids1, ids2 = encode_many(tokenizer or get_tokenizer(), [text1, text2])
+    # Sorted unique id arrays; the set operations below are vectorized merges
+    tokens1 = np.unique(np.asarray(ids1, dtype=np.int64))
+    tokens2 = np.unique(np.asarray(ids2, dtype=np.int64))
+    
+    if not tokens1.size or not tokens2.size:
         return 0.0
     
-    intersection = len(tokens1.intersection(tokens2))
-    union = len(tokens1.union(tokens2))
+    intersection = np.intersect1d(tokens1, tokens2, assume_unique=True).size
+    union = tokens1.size + tokens2.size - intersection
     
     return intersection / union if union > 0 else 0.0
 
@@ -245,21 +571,22 @@ def sanitize_text(text: str) -> str:
     if not text:
         return ""
     
-    # Remove null bytes and other control characters except newlines and tabs
-    sanitized = "".join(char for char in text if ord(char) >= 32 or char in '\n\t')
+    # Remove null bytes, DEL and other control characters except newlines and tabs
+    sanitized = text.translate(_CONTROL_CHARS)
     
     # Normalize whitespace
     sanitized = ' '.join(sanitized.split())
     
     return sanitized
 
-def estimate_tokens(text: str, tokenizer: Any) -> int:
+def estimate_tokens(text: str, tokenizer: Any = None) -> int:
     """
     Estimate the number of tokens in text without full tokenization.
     
     Args:
         text: Input text
-        tokenizer: Tiktoken tokenizer instance
+        tokenizer: Tiktoken tokenizer instance; its bytes-per-token ratio is
+            measured once on a sample. Without one, 4 bytes per token is assumed
         
     Returns:
         Estimated token count
@@ -267,8 +594,16 @@ def estimate_tokens(text: str, tokenizer: Any) -> int:
     if not text:
         return 0
     
-    # Simple estimation: average 4 characters per token
-    return len(text) // 4
+    # Bytes rather than characters: multi-byte scripts (CJK) carry more
+    # tokens per character, so a character ratio under-counts them
+    if tokenizer is None:
+        ratio = 4.0
+    else:
+        ratio = _bytes_per_token.get(tokenizer)
+        if ratio is None:
+            sample = _CALIBRATION_SAMPLE.encode("utf-8")
+            ratio = _bytes_per_token[tokenizer] = len(sample) / max(1, len(tokenizer.encode(_CALIBRATION_SAMPLE)))
+    return max(1, int(len(text.encode("utf-8")) / ratio))
 
 def validate_vector(vec: Any, expected_dim: int) -> None:
     """
@@ -284,27 +619,25 @@ def validate_vector(vec: Any, expected_dim: int) -> None:
     if vec is None:
         raise ValueError("Vector is None")
 
-    # Convert numpy arrays to list for uniform checks
+    # ndarrays are checked from dtype and shape alone; lists/tuples are
+    # converted once, which also verifies every element is numeric
     if isinstance(vec, np.ndarray):
-        if vec.ndim != 1:
-            raise ValueError(f"Expected 1-D vector, got array with ndim={vec.ndim}")
-        length = int(vec.shape[0])
+        arr = vec
+        if arr.dtype.kind not in "fiu":
+            raise ValueError(f"Vector elements are not numeric: dtype {arr.dtype}")
     elif isinstance(vec, (list, tuple)):
-        length = len(vec)
+        try:
+            arr = np.asarray(vec, dtype=np.float32)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Vector elements are not numeric: {e}")
     else:
         raise ValueError(f"Unsupported vector type: {type(vec)}")
 
-    if length != int(expected_dim):
-        raise ValueError(f"Vector dimension mismatch: expected {expected_dim}, got {length}")
+    if arr.ndim != 1:
+        raise ValueError(f"Expected 1-D vector, got array with ndim={arr.ndim}")
 
-    # Check numeric elements (fast path)
-    try:
-        # If it's a list/tuple, check a few elements to avoid heavy work
-        if length > 0:
-            sample = vec[0] if not isinstance(vec, np.ndarray) else vec[0].item()
-            float(sample)
-    except Exception as e:
-        raise ValueError(f"Vector elements are not numeric: {e}")
+    if arr.shape[0] != int(expected_dim):
+        raise ValueError(f"Vector dimension mismatch: expected {expected_dim}, got {arr.shape[0]}")
 
 def create_metadata_summary(document: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -316,10 +649,12 @@ def create_metadata_summary(document: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         Summary dictionary with key metadata
     """
+    title = document.get("title", "untitled")
     return {
         "doc_id": document.get("doc_id", "unknown"),
         "source": document.get("source", "unknown"),
-        "title": document.get("title", "untitled")[:100],  # Truncate long titles
+        "title": title[:100],  # Truncate long titles
+        "title_truncated": len(title) > 100,
         "text_length": len(document.get("text", "")),
         "author": document.get("author", "unknown"),
         "created_at": document.get("created_at", "unknown"),
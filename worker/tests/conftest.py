@@ -0,0 +1,19 @@
+"""
+Shared test fixtures.
+"""
+
+import pytest
+import tiktoken
+
+from app import utils
+
+@pytest.fixture(scope="session")
+def cl100k():
+    """cl100k_base encoding, loaded once for the whole test session."""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@pytest.fixture(autouse=True)
+def clear_embed_cache():
+    """Start every test with an empty embedding cache."""
+    utils._embed_cache.clear()
@@ -2,12 +2,32 @@
 Unit tests for the ingestion pipeline.
 """
 
+import numpy as np
 import pytest
 from unittest.mock import Mock, patch, AsyncMock
 from datetime import datetime
 
 from app.pipeline import IngestionPipeline
-from app.utils import DocumentPayload
+from app.models import DocumentPayload
+
+def make_document(doc_id, text):
+    """Complete DocumentPayload with the given id and text."""
+    return DocumentPayload(
+        doc_id=doc_id,
+        source="notion",
+        title="Test Document",
+        uri="https://example.com",
+        text=text,
+        author="Test Author",
+        created_at="2023-01-01T00:00:00Z",
+        updated_at="2023-01-01T00:00:00Z"
+    )
+
+def fake_iter_embeddings(make_row):
+    """Stand-in for _iter_embeddings that returns every row in one batch."""
+    async def iter_embeddings(texts):
+        yield list(range(len(texts))), np.array([make_row(t) for t in texts], dtype=np.float32)
+    return iter_embeddings
 
 class TestIngestionPipeline:
     """Test the ingestion pipeline functionality."""
@@ -29,7 +49,7 @@ class TestIngestionPipeline:
         
         # Same text should produce same hash
         assert hash1 == hash2
-        assert len(hash1) == 64  # SHA-256 produces 64-character hex string
+        assert len(hash1) == 64  # 256-bit BLAKE3 digest as a 64-character hex string
     
     def test_compute_content_hash_different_texts(self):
         """Test that different texts produce different hashes."""
@@ -42,53 +62,41 @@ class TestIngestionPipeline:
         assert hash1 != hash2
     
     @pytest.mark.asyncio
-    async def test_is_document_unchanged_existing_document(self):
-        """Test checking unchanged document with existing document."""
-        doc_id = "test_123"
-        content_hash = "abc123"
-        
-        with patch('psycopg2.connect') as mock_connect:
-            mock_conn = Mock()
-            mock_cursor = Mock()
-            mock_cursor.fetchone.return_value = (content_hash,)
-            mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-            mock_connect.return_value.__enter__.return_value = mock_conn
-            
-            result = await self.pipeline._is_document_unchanged(doc_id, content_hash)
-            assert result is True
+    async def test_upsert_document_metadata_unchanged_document(self):
+        """Test that the upsert reports an unchanged document when no row comes back."""
+        document = make_document("test_123", "This is test content")
+        
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.fetchrow = AsyncMock(return_value=None)
+        
+        result = await self.pipeline._upsert_document_metadata(document, "abc123")
+        assert result is False
+        args = self.pipeline.pool.fetchrow.call_args[0]
+        assert args[1] == "test_123"
+        assert args[-2:] == ("abc123", False)
     
     @pytest.mark.asyncio
-    async def test_is_document_unchanged_changed_document(self):
-        """Test checking unchanged document with changed content."""
-        doc_id = "test_123"
-        content_hash = "abc123"
-        stored_hash = "def456"
-        
-        with patch('psycopg2.connect') as mock_connect:
-            mock_conn = Mock()
-            mock_cursor = Mock()
-            mock_cursor.fetchone.return_value = (stored_hash,)
-            mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-            mock_connect.return_value.__enter__.return_value = mock_conn
-            
-            result = await self.pipeline._is_document_unchanged(doc_id, content_hash)
-            assert result is False
+    async def test_upsert_document_metadata_changed_document(self):
+        """Test that the upsert reports a new or changed document when a row comes back."""
+        document = make_document("test_123", "This is test content")
+        
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.fetchrow = AsyncMock(return_value={"doc_id": "test_123"})
+        
+        result = await self.pipeline._upsert_document_metadata(document, "abc123", force=True)
+        assert result is True
+        assert self.pipeline.pool.fetchrow.call_args[0][-1] is True
     
     @pytest.mark.asyncio
-    async def test_is_document_unchanged_new_document(self):
-        """Test checking unchanged document with new document."""
-        doc_id = "test_123"
-        content_hash = "abc123"
-        
-        with patch('psycopg2.connect') as mock_connect:
-            mock_conn = Mock()
-            mock_cursor = Mock()
-            mock_cursor.fetchone.return_value = None  # Document doesn't exist
-            mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-            mock_connect.return_value.__enter__.return_value = mock_conn
-            
-            result = await self.pipeline._is_document_unchanged(doc_id, content_hash)
-            assert result is False
+    async def test_mark_document_processed(self):
+        """Test that marking a document stores its hash and chunk count."""
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.execute = AsyncMock()
+        
+        await self.pipeline._mark_document_processed("test_123", "abc123", 4)
+        
+        args = self.pipeline.pool.execute.call_args[0]
+        assert args[1:] == ("test_123", "abc123", 4)
     
     @pytest.mark.asyncio
     async def test_log_ingestion_event(self):
@@ -98,19 +106,21 @@ class TestIngestionPipeline:
         message = "Test message"
         metadata = {"key": "value"}
         
-        with patch('psycopg2.connect') as mock_connect:
-            mock_conn = Mock()
-            mock_cursor = Mock()
-            mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-            mock_connect.return_value.__enter__.return_value = mock_conn
-            
-            await self.pipeline._log_ingestion_event(doc_id, event_type, message, metadata)
-            
-            # Verify the cursor.execute was called with correct parameters
-            mock_cursor.execute.assert_called_once()
-            call_args = mock_cursor.execute.call_args[0]
-            assert "INSERT INTO ingestion_log" in call_args[0]
-            assert call_args[1] == (doc_id, event_type, message, '{"key": "value"}')
+        pool = self.pipeline.pool = Mock()
+        pool.executemany = AsyncMock()
+        pool.close = AsyncMock()
+        self.pipeline.qdrant_client = AsyncMock()
+        
+        await self.pipeline._log_ingestion_event(doc_id, event_type, message, metadata)
+        # Events are queued; aclose() flushes whatever is pending
+        pool.executemany.assert_not_called()
+        await self.pipeline.aclose()
+        
+        # Verify the batch insert was called with correct parameters
+        pool.executemany.assert_called_once()
+        call_args = pool.executemany.call_args[0]
+        assert "INSERT INTO ingestion_log" in call_args[0]
+        assert call_args[1] == [(doc_id, event_type, message, {"key": "value"})]
     
     @pytest.mark.asyncio
     async def test_process_document_unchanged_content(self):
@@ -126,14 +136,16 @@ class TestIngestionPipeline:
             updated_at="2023-01-01T00:00:00Z"
         )
         
-        with patch.object(self.pipeline, '_is_document_unchanged', return_value=True):
-            with patch.object(self.pipeline, '_log_ingestion_event') as mock_log:
-                result = await self.pipeline.process_document(document)
-                
-                assert result["success"] is True
-                assert result["chunks_processed"] == 0
-                assert "skipped" in result["message"]
-                mock_log.assert_called_once()
+        with patch.object(self.pipeline, '_upsert_document_metadata', return_value=False):
+            with patch('app.pipeline.chunk_text') as mock_chunk:
+                with patch.object(self.pipeline, '_log_ingestion_event') as mock_log:
+                    result = await self.pipeline.process_document(document)
+                    
+                    assert result["success"] is True
+                    assert result["chunks_processed"] == 0
+                    assert "skipped" in result["message"]
+                    mock_log.assert_called_once()
+                    mock_chunk.assert_not_called()
     
     @pytest.mark.asyncio
     async def test_process_document_new_content(self):
@@ -149,15 +161,14 @@ class TestIngestionPipeline:
             updated_at="2023-01-01T00:00:00Z"
         )
         
-        with patch.object(self.pipeline, '_is_document_unchanged', return_value=False):
-            with patch.object(self.pipeline, 'get_embedding', return_value=[[0.1] * 1536] * 3):
-                with patch.object(self.pipeline.qdrant_client, 'upsert'):
-                    with patch.object(self.pipeline, '_update_document_metadata'):
-                        with patch.object(self.pipeline, '_log_ingestion_event'):
-                            result = await self.pipeline.process_document(document)
-                            
-                            assert result["success"] is True
-                            assert result["chunks_processed"] > 0
+        with patch.object(self.pipeline, '_upsert_document_metadata', return_value=True), patch.object(self.pipeline, '_mark_document_processed'):
+            with patch.object(self.pipeline, '_iter_embeddings', side_effect=fake_iter_embeddings(lambda t: [0.1] * 1536)):
+                with patch.object(self.pipeline.qdrant_client, 'upsert'), patch.object(self.pipeline.qdrant_client, 'delete'):
+                    with patch.object(self.pipeline, '_log_ingestion_event'):
+                        result = await self.pipeline.process_document(document)
+                        
+                        assert result["success"] is True
+                        assert result["chunks_processed"] > 0
     
     @pytest.mark.asyncio
     async def test_process_document_force_reindex(self):
@@ -173,16 +184,157 @@ class TestIngestionPipeline:
             updated_at="2023-01-01T00:00:00Z"
         )
         
-        with patch.object(self.pipeline, '_is_document_unchanged', return_value=True):
-            with patch.object(self.pipeline, 'get_embedding', return_value=[[0.1] * 1536]):
-                with patch.object(self.pipeline.qdrant_client, 'upsert'):
-                    with patch.object(self.pipeline, '_update_document_metadata'):
+        with patch.object(self.pipeline, '_upsert_document_metadata', return_value=True) as mock_upsert, patch.object(self.pipeline, '_mark_document_processed'):
+            with patch.object(self.pipeline, '_iter_embeddings', side_effect=fake_iter_embeddings(lambda t: [0.1] * 1536)):
+                with patch.object(self.pipeline.qdrant_client, 'upsert'), patch.object(self.pipeline.qdrant_client, 'delete'):
+                    with patch.object(self.pipeline, '_log_ingestion_event'):
+                        result = await self.pipeline.process_document(document, force_reindex=True)
+                        
+                        # Should process even if unchanged when force_reindex=True
+                        assert result["success"] is True
+                        assert result["chunks_processed"] > 0
+                        assert mock_upsert.call_args.kwargs["force"] is True
+    
+    @pytest.mark.asyncio
+    async def test_process_document_embeds_duplicate_chunks_once(self):
+        """Test that repeated chunks share one embedding request slot."""
+        document = DocumentPayload(
+            doc_id="test_123",
+            source="notion",
+            title="Test Document",
+            uri="https://example.com",
+            text="unused; chunk_text is patched",
+            author="Test Author",
+            created_at="2023-01-01T00:00:00Z",
+            updated_at="2023-01-01T00:00:00Z"
+        )
+        chunks = [
+            {"text": "footer", "tokens": [1], "token_count": 1},
+            {"text": "body", "tokens": [2], "token_count": 1},
+            {"text": "footer", "tokens": [1], "token_count": 1}
+        ]
+        
+        with patch('app.pipeline.chunk_text', return_value=chunks):
+            with patch.object(self.pipeline, '_upsert_document_metadata', return_value=True), patch.object(self.pipeline, '_mark_document_processed'):
+                with patch.object(self.pipeline, '_iter_embeddings', side_effect=fake_iter_embeddings(lambda t: [float(t[0])] * 1536)) as mock_embed:
+                    with patch.object(self.pipeline.qdrant_client, 'upsert') as mock_upsert, patch.object(self.pipeline.qdrant_client, 'delete'):
+                        with patch.object(self.pipeline, '_log_ingestion_event'):
+                            result = await self.pipeline.process_document(document)
+        
+        assert result["success"] is True
+        assert result["chunks_processed"] == 3
+        mock_embed.assert_called_once_with([[1], [2]])
+        points = mock_upsert.call_args.kwargs["points"]
+        assert {p.payload["chunk_index"]: p.vector[0] for p in points} == {0: 1.0, 1: 2.0, 2: 1.0}
+    
+    @pytest.mark.asyncio
+    async def test_process_document_upserts_each_embedding_batch_as_it_arrives(self):
+        """Test that Qdrant writes for one batch happen before later batches return."""
+        document = DocumentPayload(
+            doc_id="test_123",
+            source="notion",
+            title="Test Document",
+            uri="https://example.com",
+            text="unused; chunk_text is patched",
+            author="Test Author",
+            created_at="2023-01-01T00:00:00Z",
+            updated_at="2023-01-01T00:00:00Z"
+        )
+        chunks = [{"text": str(i), "tokens": [i], "token_count": 1} for i in range(3)]
+        upserts_seen = []
+        
+        async def two_batches(texts):
+            yield [2], np.full((1, 1536), 2.0, dtype=np.float32)
+            upserts_seen.append(mock_upsert.call_count)
+            yield [0, 1], np.full((2, 1536), 1.0, dtype=np.float32)
+        
+        with patch('app.pipeline.chunk_text', return_value=chunks):
+            with patch.object(self.pipeline, '_upsert_document_metadata', return_value=True), patch.object(self.pipeline, '_mark_document_processed'):
+                with patch.object(self.pipeline, '_iter_embeddings', side_effect=two_batches):
+                    with patch.object(self.pipeline.qdrant_client, 'upsert') as mock_upsert, patch.object(self.pipeline.qdrant_client, 'delete'):
                         with patch.object(self.pipeline, '_log_ingestion_event'):
-                            result = await self.pipeline.process_document(document, force_reindex=True)
-                            
-                            # Should process even if unchanged when force_reindex=True
-                            assert result["success"] is True
-                            assert result["chunks_processed"] > 0
+                            result = await self.pipeline.process_document(document)
+        
+        assert result["chunks_processed"] == 3
+        assert upserts_seen == [1]
+        assert mock_upsert.call_count == 2
+        first_points = mock_upsert.call_args_list[0].kwargs["points"]
+        assert [p.payload["chunk_index"] for p in first_points] == [2]
+    
+    @pytest.mark.asyncio
+    async def test_process_document_stores_hash_after_vectors(self):
+        """Test that the content hash is only stored once every point is upserted."""
+        document = make_document("test_123", "This is test content for chunking. " * 50)
+        calls = []
+        
+        async def record_upsert(**kwargs):
+            calls.append(("upsert", kwargs["wait"]))
+        
+        async def record_delete(**kwargs):
+            calls.append("delete")
+        
+        async def record_done(doc_id, content_hash, chunk_count):
+            calls.append(("done", doc_id, content_hash, chunk_count))
+        
+        with patch.object(self.pipeline, '_upsert_document_metadata', return_value=True):
+            with patch.object(self.pipeline, '_iter_embeddings', side_effect=fake_iter_embeddings(lambda t: [0.1] * 1536)):
+                with patch.object(self.pipeline.qdrant_client, 'upsert', side_effect=record_upsert), patch.object(self.pipeline.qdrant_client, 'delete', side_effect=record_delete):
+                    with patch.object(self.pipeline, '_mark_document_processed', side_effect=record_done):
+                        with patch.object(self.pipeline, '_log_ingestion_event'):
+                            result = await self.pipeline.process_document(document)
+        
+        assert calls[-1] == (
+            "done", "test_123", self.pipeline._compute_content_hash(document.text), result["chunks_processed"]
+        )
+        assert calls[-2] == "delete"
+        assert calls[:-2] and set(calls[:-2]) == {("upsert", True)}
+    
+    @pytest.mark.asyncio
+    async def test_process_document_deletes_points_beyond_new_chunk_count(self):
+        """Test that a re-ingest with fewer chunks removes the old higher-index points."""
+        document = make_document("test_123", "unused; chunk_text is patched")
+        chunks = [{"text": str(i), "tokens": [i], "token_count": 1} for i in range(2)]
+        
+        with patch('app.pipeline.chunk_text', return_value=chunks):
+            with patch.object(self.pipeline, '_upsert_document_metadata', return_value=True), patch.object(self.pipeline, '_mark_document_processed'):
+                with patch.object(self.pipeline, '_iter_embeddings', side_effect=fake_iter_embeddings(lambda t: [0.1] * 1536)):
+                    with patch.object(self.pipeline.qdrant_client, 'upsert'), patch.object(self.pipeline.qdrant_client, 'delete') as mock_delete:
+                        with patch.object(self.pipeline, '_log_ingestion_event'):
+                            result = await self.pipeline.process_document(document)
+        
+        assert result["chunks_processed"] == 2
+        conditions = mock_delete.call_args.kwargs["points_selector"].filter.must
+        assert conditions[0].key == "doc_id" and conditions[0].match.value == "test_123"
+        assert conditions[1].key == "chunk_index" and conditions[1].range.gte == 2
+    
+    @pytest.mark.asyncio
+    async def test_process_document_failure_leaves_hash_unset(self):
+        """Test that a failed embedding run never marks the document as processed."""
+        document = make_document("test_123", "This is test content")
+        
+        async def failing_embeddings(texts):
+            raise RuntimeError("embeddings unavailable")
+            yield
+        
+        with patch.object(self.pipeline, '_upsert_document_metadata', return_value=True):
+            with patch.object(self.pipeline, '_iter_embeddings', side_effect=failing_embeddings):
+                with patch.object(self.pipeline, '_mark_document_processed') as mock_done:
+                    with patch.object(self.pipeline, '_log_ingestion_event'):
+                        result = await self.pipeline.process_document(document)
+        
+        assert result["success"] is False
+        mock_done.assert_not_called()
+    
+    def test_iter_embeddings_uses_shared_semaphore(self):
+        """Test that embedding is micro-batched under the pipeline-wide semaphore."""
+        texts = [str(i) for i in range(200)]
+        
+        with patch('app.pipeline.iter_embeddings') as mock_embed:
+            self.pipeline._iter_embeddings(texts)
+        
+        kwargs = mock_embed.call_args.kwargs
+        assert kwargs["batch_size"] == 96
+        assert kwargs["semaphore"] is self.pipeline.embed_sem
     
     @pytest.mark.asyncio
     async def test_get_document_by_id_existing(self):
@@ -198,30 +350,22 @@ class TestIngestionPipeline:
             "updated_at": "2023-01-01T00:00:00Z"
         }
         
-        with patch('psycopg2.connect') as mock_connect:
-            mock_conn = Mock()
-            mock_cursor = Mock()
-            mock_cursor.fetchone.return_value = expected_doc
-            mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-            mock_connect.return_value.__enter__.return_value = mock_conn
-            
-            result = await self.pipeline.get_document_by_id(doc_id)
-            assert result == expected_doc
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.fetchrow = AsyncMock(return_value=expected_doc)
+        
+        result = await self.pipeline.get_document_by_id(doc_id)
+        assert result == expected_doc
     
     @pytest.mark.asyncio
     async def test_get_document_by_id_not_found(self):
         """Test retrieving non-existent document by ID."""
         doc_id = "nonexistent"
         
-        with patch('psycopg2.connect') as mock_connect:
-            mock_conn = Mock()
-            mock_cursor = Mock()
-            mock_cursor.fetchone.return_value = None
-            mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
-            mock_connect.return_value.__enter__.return_value = mock_conn
-            
-            result = await self.pipeline.get_document_by_id(doc_id)
-            assert result is None
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.fetchrow = AsyncMock(return_value=None)
+        
+        result = await self.pipeline.get_document_by_id(doc_id)
+        assert result is None
     
     @pytest.mark.asyncio
     async def test_sync_source(self):
@@ -235,3 +379,67 @@ class TestIngestionPipeline:
             assert result["documents_deleted"] == 0
             assert result["errors"] == []
             assert mock_log.call_count == 2  # sync_started and sync_completed
+    
+    @pytest.mark.asyncio
+    async def test_sync_source_with_documents(self):
+        """Test that sync processes only changed documents and marks missing ones deleted."""
+        documents = [
+            make_document("a", "unchanged"),
+            make_document("b", "changed")
+        ]
+        stale = [{"doc_id": "x"}, {"doc_id": "y"}, {"doc_id": "z"}]
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.fetch = AsyncMock(side_effect=[[{"doc_id": "b"}], stale])
+        self.pipeline.pool.execute = AsyncMock(return_value="UPDATE 3")
+        
+        with patch.object(self.pipeline, '_log_ingestion_event'):
+            with patch.object(self.pipeline, 'process_document', return_value={"success": True}) as mock_process:
+                with patch.object(self.pipeline.qdrant_client, 'delete') as mock_delete:
+                    result = await self.pipeline.sync_source("notion", documents)
+        
+        mock_process.assert_called_once_with(documents[1])
+        assert result["documents_processed"] == 1
+        assert result["documents_deleted"] == 3
+        changed_call, stale_call = self.pipeline.pool.fetch.call_args_list
+        assert changed_call[0][1] == ["a", "b"]
+        assert stale_call[0][1:] == ("notion", ["a", "b"])
+        # The deleted documents' points are removed before their rows are flagged
+        selector = mock_delete.call_args.kwargs["points_selector"]
+        assert selector.filter.must[0].match.any == ["x", "y", "z"]
+        assert self.pipeline.pool.execute.call_args[0][1:] == (["x", "y", "z"],)
+    
+    @pytest.mark.asyncio
+    async def test_sync_source_keeps_rows_live_when_point_delete_fails(self):
+        """Test that rows are only flagged deleted once their points are gone."""
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.fetch = AsyncMock(side_effect=[[], [{"doc_id": "x"}]])
+        self.pipeline.pool.execute = AsyncMock()
+        
+        with patch.object(self.pipeline, '_log_ingestion_event'):
+            with patch.object(self.pipeline.qdrant_client, 'delete', side_effect=RuntimeError("qdrant down")):
+                events = [e async for e in self.pipeline.sync_source_stream("notion", [make_document("a", "text")])]
+        
+        assert events == [{"event": "failed", "error": "qdrant down"}]
+        self.pipeline.pool.execute.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_sync_source_stream_yields_progress(self):
+        """Test that sync streams one event per processed document, then a summary."""
+        documents = [
+            make_document("a", "first"),
+            make_document("b", "second")
+        ]
+        self.pipeline.pool = Mock()
+        self.pipeline.pool.fetch = AsyncMock(side_effect=[[{"doc_id": "a"}, {"doc_id": "b"}], []])
+        self.pipeline.pool.execute = AsyncMock()
+        results = [{"success": True}, {"success": False, "error": "boom"}]
+        
+        with patch.object(self.pipeline, '_log_ingestion_event'):
+            with patch.object(self.pipeline, 'process_document', side_effect=results):
+                events = [e async for e in self.pipeline.sync_source_stream("notion", documents)]
+        
+        assert [e["event"] for e in events] == ["document", "document", "completed"]
+        assert events[1] == {"event": "document", "doc_id": "b", "success": False, "error": "boom"}
+        assert events[-1]["documents_processed"] == 1
+        assert events[-1]["errors"] == ["boom"]
+        assert not self.pipeline._sync_locks["notion"].locked()
@@ -2,13 +2,24 @@
 Unit tests for utility functions.
 """
 
+import asyncio
+import base64
+import json
+import random
+import httpx
+import numpy as np
+import openai
 import pytest
-import tiktoken
 from unittest.mock import Mock, patch
+from collections import OrderedDict
 from datetime import datetime
 
+from app import utils
 from app.utils import (
+    _pack_batches,
     chunk_text,
+    iter_chunks,
+    encode_cached,
     get_embedding,
     validate_document_payload,
     format_api_response,
@@ -21,9 +32,10 @@ from app.utils import (
 class TestChunkText:
     """Test text chunking functionality."""
     
-    def setup_method(self):
+    @pytest.fixture(autouse=True)
+    def setup_tokenizer(self, cl100k):
         """Set up test fixtures."""
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self.tokenizer = cl100k
     
     def test_chunk_short_text(self):
         """Test chunking of text shorter than max tokens."""
@@ -33,6 +45,7 @@ class TestChunkText:
         assert len(chunks) == 1
         assert chunks[0]["text"] == text
         assert chunks[0]["token_count"] > 0
+        assert chunks[0]["tokens"] == self.tokenizer.encode(text)
     
     def test_chunk_long_text(self):
         """Test chunking of text longer than max tokens."""
@@ -43,6 +56,34 @@ class TestChunkText:
         for chunk in chunks:
             assert chunk["token_count"] <= 50
             assert chunk["text"].strip()
+            assert chunk["token_count"] == len(chunk["tokens"])
+            assert self.tokenizer.decode(chunk["tokens"]).strip() == chunk["text"]
+
+    def test_chunk_long_text_tokenizes_once(self):
+        """Test that the document is tokenized in one call however many chunks it yields."""
+        text = "Tokenize me exactly once, please. " * 200
+
+        with patch.object(self.tokenizer, 'encode_ordinary_batch',
+                          wraps=self.tokenizer.encode_ordinary_batch) as spy:
+            chunks = chunk_text(text, self.tokenizer, max_tokens=40, overlap_tokens=5)
+
+        assert len(chunks) > 10
+        spy.assert_called_once()
+
+    def test_chunk_text_with_special_token_strings(self):
+        """Test that special-token strings in a document are chunked as plain text."""
+        text = "Docs may quote <|endoftext|> literally."
+        chunks = chunk_text(text, self.tokenizer)
+
+        assert chunks[0]["tokens"] == self.tokenizer.encode_ordinary(text)
+
+    def test_iter_chunks_matches_chunk_text(self):
+        """Test that the generator yields the same chunks lazily."""
+        text = "This is a test sentence. " * 100
+        chunks = iter_chunks(text, self.tokenizer, max_tokens=60, overlap_tokens=10)
+        
+        assert next(chunks) == chunk_text(text, self.tokenizer, max_tokens=60, overlap_tokens=10)[0]
+        assert list(iter_chunks("", self.tokenizer)) == []
     
     def test_chunk_empty_text(self):
         """Test chunking of empty text."""
@@ -54,6 +95,47 @@ class TestChunkText:
         chunks = chunk_text("   \n\t   ", self.tokenizer)
         assert chunks == []
 
+class TestEncodeCached:
+    """Test block-cached tokenization."""
+    
+    @pytest.fixture(autouse=True)
+    def setup_tokenizer(self, cl100k):
+        """Set up test fixtures."""
+        self.tokenizer = cl100k
+    
+    def test_matches_plain_encode(self):
+        """Test that block-wise ids equal encoding the whole text."""
+        text = "First paragraph, it's here.\n\nSecond one!\n  indented\nlast line 12345"
+        assert encode_cached(text, self.tokenizer) == self.tokenizer.encode_ordinary(text)
+        # Second call is served from the cache
+        assert encode_cached(text, self.tokenizer) == self.tokenizer.encode_ordinary(text)
+    
+    def test_only_changed_blocks_are_encoded(self):
+        """Test that re-encoding an edited text only tokenizes new blocks."""
+        encode_cached("Intro stays.\nBody v1.\nOutro stays.\n", self.tokenizer)
+        
+        with patch.object(self.tokenizer, 'encode_ordinary_batch', wraps=self.tokenizer.encode_ordinary_batch) as spy:
+            encode_cached("Intro stays.\nBody v2.\nOutro stays.\n", self.tokenizer)
+        
+        spy.assert_called_once()
+        assert spy.call_args[0][0] == ["Body v2.\n"]
+    
+    def test_cache_is_bounded_by_size(self, monkeypatch):
+        """Test that the cache keeps neither oversized blocks nor more than its character budget."""
+        monkeypatch.setattr(utils, "_encode_cache", OrderedDict())
+        monkeypatch.setattr(utils, "_encode_cache_chars", 0)
+        monkeypatch.setattr(utils, "ENCODE_CACHE_MAX_CHARS", 50)
+        monkeypatch.setattr(utils, "ENCODE_CACHE_MAX_BLOCK_CHARS", 20)
+        
+        long_line = "no newline here " * 10
+        assert encode_cached(long_line, self.tokenizer) == self.tokenizer.encode_ordinary(long_line)
+        assert not utils._encode_cache
+        
+        encode_cached("".join(f"line {i}\n" for i in range(20)), self.tokenizer)
+        cached = [block for _, block in utils._encode_cache]
+        assert utils._encode_cache_chars == sum(map(len, cached)) <= 50
+        assert "line 19\n" in cached
+
 class TestGetEmbedding:
     """Test embedding generation functionality."""
     
@@ -69,9 +151,9 @@ class TestGetEmbedding:
             mock_to_thread.return_value = mock_response
             embeddings = await get_embedding(["test text"], mock_client)
             
-            assert len(embeddings) == 1
-            assert len(embeddings[0]) == 3
-            assert embeddings[0] == [0.1, 0.2, 0.3]
+            assert embeddings.dtype == np.float32
+            assert embeddings.shape == (1, 3)
+            assert np.allclose(embeddings[0], [0.1, 0.2, 0.3])
     
     @pytest.mark.asyncio
     async def test_get_embedding_multiple_texts(self):
@@ -82,21 +164,180 @@ class TestGetEmbedding:
             Mock(embedding=[0.1, 0.2, 0.3]),
             Mock(embedding=[0.4, 0.5, 0.6])
         ]
+        mock_client.embeddings.create.return_value = mock_response
         
-        with patch('app.utils.asyncio.to_thread') as mock_to_thread:
-            mock_to_thread.return_value = mock_response
-            embeddings = await get_embedding(["text1", "text2"], mock_client)
-            
-            assert len(embeddings) == 2
-            assert embeddings[0] == [0.1, 0.2, 0.3]
-            assert embeddings[1] == [0.4, 0.5, 0.6]
+        embeddings = await get_embedding(["text1", "text2"], mock_client)
+        
+        mock_client.embeddings.create.assert_called_once_with(
+            model="text-embedding-3-small", input=["text1", "text2"]
+        )
+        assert embeddings.shape == (2, 3)
+        assert np.allclose(embeddings, [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
+    
+    @pytest.mark.asyncio
+    async def test_get_embedding_sends_one_request_per_batch(self):
+        """Test that a list within the batch size is embedded in a single request."""
+        texts = [f"text {i}" for i in range(100)]
+        mock_client = Mock()
+        mock_client.embeddings.create.return_value = Mock(
+            data=[Mock(embedding=[float(i)]) for i in range(100)]
+        )
+        
+        embeddings = await get_embedding(texts, mock_client)
+        
+        assert mock_client.embeddings.create.call_count == 1
+        assert len(embeddings) == 100
+    
+    @pytest.mark.asyncio
+    async def test_get_embedding_batches_preserve_order(self):
+        """Test that large inputs are split into requests and reassembled in order."""
+        mock_client = Mock()
+        
+        def fake_create(create, model, input):
+            return Mock(data=[Mock(embedding=[float(t), 0.0]) for t in input])
+        
+        with patch('app.utils.asyncio.to_thread', side_effect=fake_create) as mock_to_thread:
+            embeddings = await get_embedding([str(i) for i in range(200)], mock_client, batch_size=96)
+        
+        assert mock_to_thread.call_count == 3  # 96 + 96 + 8
+        assert embeddings[:, 0].tolist() == [float(i) for i in range(200)]
+    
+    @pytest.mark.asyncio
+    async def test_get_embedding_sub_batches_concurrent(self):
+        """Test that sub-batches are in flight together, up to the concurrency limit."""
+        in_flight = 0
+        peak = 0
+        
+        async def fake_create(model, input):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return Mock(data=[Mock(embedding=[float(t)]) for t in input])
+        
+        mock_client = Mock()
+        mock_client.embeddings.create = fake_create
+        
+        embeddings = await get_embedding(
+            [str(i) for i in range(80)], mock_client, batch_size=10, max_concurrency=3
+        )
+        
+        assert peak == 3
+        assert embeddings[:, 0].tolist() == [float(i) for i in range(80)]
+    
+    @pytest.mark.asyncio
+    async def test_get_embedding_preserves_input_order_with_varied_lengths(self):
+        """Test that length-sorted batches are scattered back to input order."""
+        rng = random.Random(0)
+        texts = [f"{i} " + "word " * rng.randint(0, 200) for i in range(20)]
+        requests = []
+        
+        def fake_create(model, input):
+            requests.append(input)
+            return Mock(data=[Mock(embedding=[float(t.split()[0])]) for t in input])
+        
+        mock_client = Mock()
+        mock_client.embeddings.create.side_effect = fake_create
+        
+        embeddings = await get_embedding(texts, mock_client, batch_size=4)
+        
+        assert embeddings[:, 0].tolist() == [float(i) for i in range(20)]
+        # Similar lengths share a request: the requests cover disjoint length ranges
+        ranges = sorted((min(map(len, r)), max(map(len, r))) for r in requests)
+        assert len(ranges) == 5
+        assert all(hi <= next_lo for (_, hi), (next_lo, _) in zip(ranges, ranges[1:]))
+    
+    def test_pack_batches_respects_budgets(self):
+        """Test first-fit decreasing packing under token and item limits."""
+        batches = _pack_batches([5, 1, 9, 3, 7, 2], max_tokens=10, max_items=3)
+        
+        assert sorted(i for batch in batches for i in batch) == list(range(6))
+        assert batches == [[2, 1], [4, 3], [0, 5]]
+    
+    @pytest.mark.asyncio
+    async def test_get_embedding_reuses_cached_embeddings(self):
+        """Test that repeated inputs, within and across calls, are only sent once."""
+        mock_client = Mock()
+        mock_client.embeddings.create.side_effect = lambda model, input: Mock(
+            data=[Mock(embedding=[float(len(t)), 1.0]) for t in input]
+        )
+        
+        first = await get_embedding(["same", "other text", "same"], mock_client)
+        second = await get_embedding(["other text", "same"], mock_client)
+        
+        mock_client.embeddings.create.assert_called_once_with(
+            model="text-embedding-3-small", input=["other text", "same"]
+        )
+        assert np.allclose(first, [[4.0, 1.0], [10.0, 1.0], [4.0, 1.0]])
+        assert np.allclose(second, [[10.0, 1.0], [4.0, 1.0]])
     
     @pytest.mark.asyncio
     async def test_get_embedding_empty_list(self):
         """Test embedding generation for empty text list."""
         mock_client = Mock()
         embeddings = await get_embedding([], mock_client)
-        assert embeddings == []
+        assert len(embeddings) == 0
+
+def fake_openai_client(embed):
+    """
+    Real AsyncOpenAI client whose HTTP requests are answered in-process.
+    
+    A fake /embeddings endpoint embeds each input with embed(), honouring the
+    client's encoding_format, so request and response (de)serialization run
+    exactly as against the API.
+    """
+    request_bodies = []
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        request_bodies.append(body)
+        vectors = np.asarray([embed(item) for item in body["input"]], dtype=np.float32)
+        if body.get("encoding_format") == "base64":
+            data = [base64.b64encode(vector.tobytes()).decode() for vector in vectors]
+        else:
+            data = vectors.tolist()
+        return httpx.Response(200, json={
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": e} for i, e in enumerate(data)],
+            "model": body["model"],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0}
+        })
+    
+    client = openai.AsyncOpenAI(
+        api_key="test-key",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    return client, request_bodies
+
+class TestGetEmbeddingContract:
+    """Test embedding generation through the real OpenAI client and HTTP layer."""
+    
+    @pytest.mark.asyncio
+    async def test_get_embedding_over_http(self):
+        """Test that texts round-trip through the embeddings endpoint in input order."""
+        client, request_bodies = fake_openai_client(lambda text: [len(text), 1.0])
+        
+        embeddings = await get_embedding(["alpha", "beta gamma", "delta"], client)
+        await client.close()
+        
+        assert len(request_bodies) == 1
+        assert request_bodies[0]["model"] == "text-embedding-3-small"
+        assert sorted(request_bodies[0]["input"]) == ["alpha", "beta gamma", "delta"]
+        assert embeddings.dtype == np.float32
+        assert np.allclose(embeddings, [[5.0, 1.0], [10.0, 1.0], [5.0, 1.0]])
+    
+    @pytest.mark.asyncio
+    async def test_get_embedding_token_ids_over_http(self):
+        """Test that pre-tokenized inputs are sent as id arrays."""
+        client, request_bodies = fake_openai_client(lambda ids: [sum(ids), len(ids)])
+        
+        embeddings = await get_embedding([[1, 2, 3], [40]], client)
+        await client.close()
+        
+        assert sorted(request_bodies[0]["input"]) == [[1, 2, 3], [40]]
+        assert np.allclose(embeddings, [[6.0, 3.0], [40.0, 1.0]])
 
 class TestValidateDocumentPayload:
     """Test document payload validation."""
@@ -161,6 +402,23 @@ class TestValidateDocumentPayload:
         errors = validate_document_payload(payload)
         assert any("Invalid timestamp format for created_at" in error for error in errors)
 
+    def test_impossible_calendar_timestamp(self):
+        """Test that well-formed but impossible dates and times are rejected."""
+        payload = {
+            "doc_id": "test_123",
+            "source": "notion",
+            "title": "Test Document",
+            "uri": "https://example.com/doc",
+            "text": "This is test content",
+            "author": "Test Author",
+            "created_at": "2024-02-30T00:00:00Z",
+            "updated_at": "2024-01-01T24:00:00Z"
+        }
+
+        errors = validate_document_payload(payload)
+        assert any("Invalid timestamp format for created_at" in error for error in errors)
+        assert any("Invalid timestamp format for updated_at" in error for error in errors)
+
 class TestFormatApiResponse:
     """Test API response formatting."""
     
@@ -176,7 +434,23 @@ class TestFormatApiResponse:
         assert response["message"] == "Operation completed"
         assert response["data"] == {"key": "value"}
         assert "timestamp" in response
-    
+        assert abs((datetime.fromisoformat(response["timestamp"]) - datetime.utcnow()).total_seconds()) < 5
+
+    def test_timestamp_formatted_once_per_second(self):
+        """Test that responses within the same second reuse the formatted date/time."""
+        clock = [1700000000.25, 1700000000.75, 1700000001.5, 1700000002.0]
+        with patch('app.utils.time.time', side_effect=clock), \
+             patch('app.utils.datetime', wraps=datetime) as mock_datetime:
+            stamps = [format_api_response(True, "ok")["timestamp"] for _ in clock]
+
+        assert stamps == [
+            "2023-11-14T22:13:20.250000",
+            "2023-11-14T22:13:20.750000",
+            "2023-11-14T22:13:21.500000",
+            "2023-11-14T22:13:22",
+        ]
+        assert mock_datetime.fromtimestamp.call_count == 3
+
     def test_error_response(self):
         """Test formatting of error response."""
         response = format_api_response(
@@ -192,9 +466,10 @@ class TestFormatApiResponse:
 class TestCalculateTextSimilarity:
     """Test text similarity calculation."""
     
-    def setup_method(self):
+    @pytest.fixture(autouse=True)
+    def setup_tokenizer(self, cl100k):
         """Set up test fixtures."""
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self.tokenizer = cl100k
     
     def test_identical_texts(self):
         """Test similarity of identical texts."""
@@ -213,6 +488,14 @@ class TestCalculateTextSimilarity:
         """Test similarity with empty texts."""
         similarity = calculate_text_similarity("", "", self.tokenizer)
         assert similarity == 0.0
+    
+    def test_identical_and_empty_texts_skip_tokenizer(self):
+        """Test that identical or empty inputs are scored without tokenizing."""
+        tokenizer = Mock()
+        
+        assert calculate_text_similarity("same text", "same text", tokenizer) == 1.0
+        assert calculate_text_similarity("", "some text", tokenizer) == 0.0
+        tokenizer.encode_ordinary_batch.assert_not_called()
 
 class TestSanitizeText:
     """Test text sanitization."""
@@ -225,10 +508,11 @@ class TestSanitizeText:
     
     def test_sanitize_text_with_control_chars(self):
         """Test sanitization of text with control characters."""
-        text = "Text with\x00null\x01bytes"
+        text = "Text with\x00null\x01bytes\x7f"
         sanitized = sanitize_text(text)
         assert "\x00" not in sanitized
         assert "\x01" not in sanitized
+        assert sanitized == "Text withnullbytes"
     
     def test_sanitize_whitespace(self):
         """Test sanitization of excessive whitespace."""
@@ -240,9 +524,10 @@ class TestSanitizeText:
 class TestEstimateTokens:
     """Test token estimation."""
     
-    def setup_method(self):
+    @pytest.fixture(autouse=True)
+    def setup_tokenizer(self, cl100k):
         """Set up test fixtures."""
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self.tokenizer = cl100k
     
     def test_estimate_tokens_normal_text(self):
         """Test token estimation for normal text."""
@@ -255,6 +540,16 @@ class TestEstimateTokens:
         estimated = estimate_tokens("", self.tokenizer)
         assert estimated == 0
 
+    def test_estimate_tokens_calibrates_once_per_tokenizer(self):
+        """Test that repeated estimates never re-run the tokenizer."""
+        tokenizer = Mock()
+        tokenizer.encode.return_value = [0] * 100
+
+        estimates = [estimate_tokens(text, tokenizer) for text in ("same text", "same text", "other text")]
+
+        tokenizer.encode.assert_called_once()
+        assert estimates[0] == estimates[1] > 0
+
 class TestCreateMetadataSummary:
     """Test metadata summary creation."""
     
@@ -275,6 +570,7 @@ class TestCreateMetadataSummary:
         assert summary["doc_id"] == "test_123"
         assert summary["source"] == "notion"
         assert len(summary["title"]) <= 100  # Should be truncated
+        assert summary["title_truncated"] is (len(document["title"]) > 100)
         assert summary["text_length"] == len(document["text"])
         assert summary["author"] == "Test Author"
     
@@ -287,4 +583,5 @@ class TestCreateMetadataSummary:
         assert summary["doc_id"] == "test_123"
         assert summary["source"] == "unknown"
         assert summary["title"] == "untitled"
+        assert summary["title_truncated"] is False
         assert summary["text_length"] == 0